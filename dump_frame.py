@@ -1,9 +1,11 @@
 import sys
-import os
 import shutil
 import time
+import queue
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from PIL import Image, ImageDraw, ImageFont
+import qdx
 
 from moviepy.editor import concatenate_videoclips, ImageClip
 
@@ -35,86 +37,140 @@ expected_header = f"JieHe,{LH},{X},{Y},2,030,0,FA"      # Galaxy 1
 def vlog(msg):
     print(f"{datetime.fromtimestamp(time.time()-start_time).strftime('%H:%M:%S')} - {msg}")
 
-def dump_layer(filename):
+# Layers are taken in increasing order, each one is read straight from its offset in the layer index,
+# or from its block in a qdr run store
+def dump_layers(filename):
     try:
         vlog("Opening and reading the file...")
-        with open(filename, 'r') as file:
-            first_line = file.readline()
-            
+        with qdx.LayerReader(filename) as reader:
             # Validate header
-            vlog("Validating header...")
-            header = first_line.strip()
-            if header == expected_header:
-                vlog(f"Header is compliant: LH={LH}, X={X}, Y={Y}")
-            else:
-                vlog(f"Header compliance failed: found {header}")
-
-            # Create an empty (black) image
-            img = Image.new('RGB', (Y, X), 'black')
-            draw = ImageDraw.Draw(img)
-
-            current_layer = 0
-            in_image = False
-            in_layer = False
-
-            for line in file:
-                line = line.strip()
-
-                if line.isdigit():
-                    current_layer = int(line)
-                    if current_layer == the_layer:
-                        vlog(f"Processing layer {current_layer}...")
-                        in_layer = True
-                
-                elif line == "FB" and in_layer == True:
-                    in_image = True
-                    prev_row = 0
-                    prev_displacement = 0;
-                
-                elif line == "FC" and in_image == True:
-                    base, extension = os.path.splitext(filename)
-                    temp_image_path = f"{base}{current_layer}.png"
-                    img.save(temp_image_path)
-                    break
- 
-                elif line == "FD":
-                    vlog("Layer number not found in file")
-                    break  # Recap section starts, stop processing
-
-                elif in_image == True:
-                    # Data line processing
-                    parts = line.split(',')
-                    if len(parts) == 3:  # Row data line
-                        row, displacement, laser_on = map(int, parts)
-                        if prev_row != row:
-                            prev_row = row
-                            prev_displacement = 0
-
-                        rd_to = prev_displacement + displacement
-                        if rd_to <= X:
-                            to_fill = "white"
-                        else:
-                            to_fill = "red"
-                            rd_to = X
-                            laser_on = 1
-                        if laser_on == 1:
-                            if current_layer %2 == 1:
-                                draw.line((row, prev_displacement, row, rd_to), fill=to_fill)
-                            else:
-                                draw.line((Y - row, prev_displacement, Y - row, rd_to), fill=to_fill)
-                        prev_displacement = rd_to
+            validate_header(reader.header)
+
+            with FramePool() as frames:
+                for current_layer in the_layers:
+                    layer = reader.layer(current_layer)
+                    if layer is None:
+                        vlog(f"Layer {current_layer} not found in file")
+                        continue
+
+                    vlog(f"Processing layer {current_layer}...")
+                    # With preview, the thumbnail before "FB" is drawn instead of the print
+                    rows, displacements, laser_ons = (values.tolist() for values in
+                                                      (layer.thumbnail if preview else layer.main))
+                    save_layer(frames, filename, current_layer, rows, displacements, laser_ons, preview)
     
     except FileNotFoundError:
         vlog(f"Error: The file '{filename}' was not found.")
 
+def validate_header(header):
+    vlog("Validating header...")
+    if header == expected_header:
+        vlog(f"Header is compliant: LH={LH}, X={X}, Y={Y}")
+    else:
+        vlog(f"Header compliance failed: found {header}")
+
+# With preview, the layer is the 400 x 800 thumbnail before "FB"
+def save_layer(frames, filename, current_layer, rows, displacements, laser_ons, preview=False):
+    # Clear a frame buffer (fill it with black)
+    img = frames.frame()
+    width, height = img.size
+    draw = ImageDraw.Draw(img)
+    draw.rectangle([(0, 0), (width, height)], fill='black')
+    draw_section(draw, current_layer, rows, displacements, laser_ons, height, width)
+    base = qdx.base_path(filename)
+    frames.save(img, f"{base}{current_layer}{'_preview' if preview else ''}.png")
+
+# A few frame buffers, reused from one layer to the next, and the threads that save them as PNG,
+# so that compressing a layer overlaps reading and drawing the next one
+# With preview, the frames are the size of the thumbnail
+class FramePool:
+    writers = 2     # every full size frame buffer takes 96 MB
+
+    def __enter__(self):
+        size = (Y // 10, X // 10) if preview else (Y, X)
+        self.free = queue.Queue()
+        for _ in range(self.writers + 1):
+            self.free.put(Image.new('RGB', size, 'black'))
+        self.executor = ThreadPoolExecutor(max_workers=self.writers)
+        self.saving = []
+        return self
+
+    # A free frame buffer, once its previous layer is saved
+    def frame(self):
+        return self.free.get()
+
+    def save(self, img, path):
+        # Forget the layers already saved, raising the error of a writer as soon as it is known
+        for saving in [saving for saving in self.saving if saving.done()]:
+            saving.result()
+            self.saving.remove(saving)
+        self.saving.append(self.executor.submit(self.write, img, path))
+
+    def write(self, img, path):
+        try:
+            img.save(path)
+        finally:
+            self.free.put(img)
+
+    # Wait for the last layers, and raise the first error of the writers, if any
+    def __exit__(self, *exc_info):
+        self.executor.shutdown()
+        for saving in self.saving:
+            saving.result()
+
+# Draw the segments of a layer section, in red where they exceed the height of the image
+def draw_section(draw, current_layer, rows, displacements, laser_ons, height=X, width=Y):
+    prev_row = 0
+    prev_displacement = 0
+    for row, displacement, laser_on in zip(rows, displacements, laser_ons):
+        if prev_row != row:
+            prev_row = row
+            prev_displacement = 0
+
+        rd_to = prev_displacement + displacement
+        if rd_to <= height:
+            to_fill = "white"
+        else:
+            to_fill = "red"
+            rd_to = height
+            laser_on = 1
+        if laser_on == 1:
+            if current_layer %2 == 1:
+                draw.line((row, prev_displacement, row, rd_to), fill=to_fill)
+            else:
+                draw.line((width - row, prev_displacement, width - row, rd_to), fill=to_fill)
+        prev_displacement = rd_to
+
+# Layer numbers from a list of layers and ranges such as 10,20,100-200:10, in increasing order
+def parse_layers(spec):
+    layers = set()
+    for item in spec.split(","):
+        span, _, step = item.partition(":")
+        first, _, last = span.partition("-")
+        bounds = [first, last or first, step or "1"]
+        if not all(bound.isdigit() for bound in bounds) or int(bounds[2]) == 0:
+            raise ValueError(f"'{item}' is not a layer, nor a range of layers")
+        first, last, step = map(int, bounds)
+        layers.update(range(first, last + 1, step))
+    return sorted(layers)
+
 if __name__ == "__main__":
     if len(sys.argv) < 3:
-        print("Usage: python dump_frame.py <filename> <layer>")
+        print("Usage: python dump_frame.py <filename> <layers> [--preview]")
+        print("       <filename> is a qdx file, also compressed as .qdx.gz or .qdx.xz, or a qdr run store written by qdxfromPNG.py")
+        print("       <layers> is a layer, or a list of layers and ranges such as 10,20,100-200:10")
+        print("                (every 10th layer from 100 to 200), each one saved in <filename><layer>.png")
+        print("       --preview draws the 400 x 800 thumbnail of the layers in <filename><layer>_preview.png")
         sys.exit(1)
 
     vlog("Start...")
     filename = sys.argv[1]
-    the_layer = int(sys.argv[2])
+    try:
+        the_layers = parse_layers(sys.argv[2])
+    except ValueError as error:
+        print(f"Error: {error}")
+        sys.exit(1)
+    preview = "--preview" in sys.argv[3:]
 
-    dump_layer(filename)
+    dump_layers(filename)
     vlog("Finished")
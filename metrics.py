@@ -0,0 +1,106 @@
+import os
+import sys
+import csv
+import json
+import time
+from contextlib import contextmanager, nullcontext
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+#################################################
+#
+# Opt-in performance metrics of qdxfromPNG.py and qdxanalyzer.py (--metrics).
+#
+# Every layer gets a record of the seconds spent in each stage and of its
+# counters (triplets, lines, bytes). The records and the totals of the run
+# are written next to the output file:
+#
+#   <output>_<tool>.json:  run totals, rates, peak RSS and the layer records
+#   <output>_<tool>.csv:   one row per layer, one column per stage or counter
+#
+# Stage and counter names are shared between runs, so that the reports of
+# two releases can be compared column by column.
+#
+#################################################
+
+def peak_rss_mb(who=None):
+    """Return the peak resident set size in MB, or None where unsupported."""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF if who is None else who).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return rss / 1024 / (1024 if sys.platform == "darwin" else 1)
+
+class Metrics:
+    """Per layer stage timings and counters of a run.
+
+    Disabled metrics record nothing, and stage() costs a no-op context,
+    so the tools can be instrumented unconditionally.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.layers = {}
+        self.start = time.perf_counter()
+
+    def stage(self, layer, name):
+        """Return a context that adds the seconds spent in it to the name stage of layer."""
+        return self.timer(layer, name) if self.enabled else nullcontext()
+
+    @contextmanager
+    def timer(self, layer, name):
+        since = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(layer, **{name: time.perf_counter() - since})
+
+    def add(self, layer, **values):
+        """Add values to the stages or counters of layer."""
+        if self.enabled:
+            record = self.layers.setdefault(layer, {})
+            for name, value in values.items():
+                record[name] = record.get(name, 0) + value
+
+    def merge(self, layers):
+        """Add the layer records of another process, e.g. a worker."""
+        for layer, values in layers.items():
+            self.add(layer, **values)
+
+    def report(self, tool):
+        """Return the run totals, the rates and the layer records as a dict."""
+        elapsed = time.perf_counter() - self.start
+        names = list(dict.fromkeys(name for record in self.layers.values() for name in record))
+        totals = {name: sum(record.get(name, 0) for record in self.layers.values()) for name in names}
+        rates = {f"{name}_per_second": totals.get(name, 0) / elapsed for name in ("triplets", "lines", "bytes")}
+        rates["layers_per_second"] = len(self.layers) / elapsed
+        return {
+            "tool": tool,
+            "finished": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "seconds": elapsed,
+            "layers": len(self.layers),
+            "peak_rss_mb": peak_rss_mb(),
+            "peak_rss_worker_mb": peak_rss_mb(resource.RUSAGE_CHILDREN) if resource is not None else None,
+            "totals": totals,
+            "rates": rates,
+            "layer_records": [{"layer": layer, **self.layers[layer]} for layer in sorted(self.layers)],
+        }
+
+    def write(self, output_file, tool):
+        """Write the JSON and CSV reports next to output_file, and return the path of the JSON one."""
+        if not self.enabled:
+            return None
+        report = self.report(tool)
+        # Next to x.qdx.gz as next to x.qdx
+        if output_file.endswith((".gz", ".xz")):
+            output_file = output_file[:-3]
+        base = f"{os.path.splitext(output_file)[0]}_{tool}"
+        with open(base + ".json", "w") as file:
+            json.dump(report, file, indent=1)
+        with open(base + ".csv", "w", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=["layer", *report["totals"]], restval=0)
+            writer.writeheader()
+            writer.writerows(report["layer_records"])
+        return base + ".json"
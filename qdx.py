@@ -0,0 +1,767 @@
+import os
+import gzip
+import lzma
+import mmap
+import zlib
+import struct
+import threading
+from collections import OrderedDict
+import numpy as np
+
+#################################################
+#
+# Shared helpers for the QDX file format of the Galaxy 1 (see qdxanalyzer.py)
+# and for its compact binary counterpart, the QDR run store.
+#
+# The tools read the layers of both formats as Layer objects through
+# LayerReader, and write QDX files through QdxWriter, so that they all share
+# the same parser and serializer.
+#
+# QDR file format, all integers little endian:
+#
+# header:           "QDXRUNS1", then the QDX header line padded with zeros to 64 bytes
+# for each layer repeated:
+#   block header:     uint32 thumbnail runs, uint32 main runs
+#   runs:             thumbnail runs then main runs, 5 bytes each:
+#                     uint16 column, uint16 count, uint8 value
+# layer table:      int64 (block offset, thumbnail runs, main runs) for each layer
+# trailer:          uint64 layer table offset, uint64 layers, "QDXRUNS1"
+#
+# The runs are the QDX triplets (row, displacement, laser_on) as numbers,
+# so a layer is read by slicing the memory mapped file, without parsing.
+#
+# QDXI layer index, the .qdxi sidecar of a QDX file:
+#
+# header:           "QDXINDX1", uint64 QDX file size, uint64 QDX file mtime in ns, uint64 layers
+# for each layer:   int64 layer number, byte offsets of its counter line, "FB" and "FC",
+#                   and its thumbnail plus main triplets
+# for a compressed QDX file:
+#   uint64 blocks + 1, then int64 (offset, compressed offset) for each block,
+#   and the decompressed and compressed sizes of the file
+#
+# The index is rebuilt when the size or the mtime of the QDX file changes.
+#
+# Compressed QDX files, .qdx.gz and .qdx.xz, the sidecar being .gz.qdxi or .xz.qdxi:
+#
+# The file is a series of independent gzip members or xz streams, so a
+# standard gzip -d or xz -d restores the QDX file. Each one holds whole
+# layers, about COMPRESSED_BLOCK_SIZE bytes of them, so that a layer is
+# read by decompressing its block only. The byte offsets of the index are
+# those of the decompressed file.
+#
+#################################################
+
+RUN_DTYPE = np.dtype([("column", "<u2"), ("count", "<u2"), ("value", "u1")])
+RUNS_MAGIC = b"QDXRUNS1"
+RUNS_HEADER = struct.Struct("<8s64s")
+BLOCK_HEADER = struct.Struct("<II")
+RUNS_TRAILER = struct.Struct("<QQ8s")
+INDEX_DTYPE = np.dtype([("layer", "<i8"), ("counter", "<i8"), ("fb", "<i8"), ("fc", "<i8"), ("triplets", "<i8")])
+INDEX_MAGIC = b"QDXINDX1"
+INDEX_HEADER = struct.Struct("<8sQQQ")
+BLOCKS_HEADER = struct.Struct("<Q")
+COMPRESSIONS = (".gz", ".xz")
+QDX_EXTENSIONS = (".qdx", ".qdx.gz", ".qdx.xz")
+COMPRESSED_BLOCK_SIZE = 1 << 20
+GZIP_LEVEL = 6
+XZ_PRESET = 6
+
+def format_triplets(columns, counts, values):
+    """Format runs as "column,count,value\\n" lines in a single bytes object.
+
+    All lines are laid out side by side in a fixed width character matrix,
+    and the leading zeros of each number are masked out at the end.
+    """
+    if len(columns) == 0:
+        return b""
+    fields = [decimal_digits(columns), separator(len(columns), b","),
+              decimal_digits(counts), separator(len(columns), b","),
+              decimal_digits(values), separator(len(columns), b"\n")]
+    chars = np.hstack([chars for chars, _ in fields])
+    keep = np.hstack([keep for _, keep in fields])
+    return chars[keep].tobytes()
+
+def triplets_size(columns, counts, values):
+    """Return the size in bytes of the formatted triplets, without formatting them."""
+    # Every line has two commas and a newline besides the digits
+    return int(decimal_width(columns).sum() + decimal_width(counts).sum() + decimal_width(values).sum()) + 3 * len(columns)
+
+def decimal_width(numbers):
+    """Return the number of decimal digits of each non negative number."""
+    width = np.ones(len(numbers), dtype=np.int64)
+    if len(numbers):
+        power = 10
+        while power <= numbers.max():
+            width += numbers >= power
+            power *= 10
+    return width
+
+def decimal_digits(numbers):
+    """Return the ASCII digits of non negative numbers and a mask of the significant ones."""
+    numbers = np.asarray(numbers, dtype=np.int64)[:, None]
+    powers = 10 ** np.arange(len(str(int(numbers.max()))) - 1, -1, -1, dtype=np.int64)
+    chars = (numbers // powers % 10 + ord("0")).astype(np.uint8)
+    keep = (numbers >= powers) | (powers == 1)
+    return chars, keep
+
+def separator(lines, char):
+    return np.full((lines, 1), ord(char), dtype=np.uint8), np.ones((lines, 1), dtype=bool)
+
+def parse_triplets(data):
+    """Parse "column,count,value\\n" lines into three int64 arrays.
+
+    The inverse of format_triplets: the numbers are summed from their
+    digits, one decimal position at a time, without a Python loop over
+    the lines. Returns None if data holds anything but such lines, so
+    that the caller can fall back to a line by line parser.
+    """
+    chars = np.frombuffer(data, dtype=np.uint8)
+    if len(chars) == 0:
+        return (np.zeros(0, dtype=np.int64),) * 3
+    # Every number ends at a separator, and the separators of a line are ",", "," and "\n"
+    separators = np.flatnonzero((chars < ord("0")) | (chars > ord("9")))
+    widths = np.diff(separators, prepend=-1) - 1
+    if (len(separators) % 3 or separators[-1] != len(chars) - 1 or widths.min() == 0 or widths.max() > 18
+            or (chars[separators].reshape(-1, 3) != np.array([44, 44, 10], dtype=np.uint8)).any()):
+        return None
+    digits = chars.astype(np.int64) - ord("0")
+    numbers = digits[separators - 1]
+    for position in range(2, widths.max() + 1):
+        numbers += np.where(widths >= position, digits[separators - position], 0) * 10 ** (position - 1)
+    numbers = numbers.reshape(-1, 3)
+    return numbers[:, 0], numbers[:, 1], numbers[:, 2]
+
+def segment_bounds(rows, segment_lengths):
+    """Return the index of the first segment of every row, and the X coordinate where every segment ends."""
+    # The segments of a row are consecutive, a new row starts where the row number changes
+    row_starts = np.flatnonzero(np.diff(rows, prepend=-1) != 0)
+    ends = np.cumsum(segment_lengths)
+    segment_ends = ends - np.repeat((ends - segment_lengths)[row_starts], np.diff(row_starts, append=len(rows)))
+    return row_starts, segment_ends
+
+def pack_runs(columns, counts, values):
+    """Return the runs as a RUN_DTYPE array."""
+    runs = np.empty(len(columns), dtype=RUN_DTYPE)
+    runs["column"] = columns
+    runs["count"] = counts
+    runs["value"] = values
+    return runs
+
+def runs_block(thumb_runs, main_runs):
+    """Return the QDR block of a layer from its thumbnail and main RUN_DTYPE arrays."""
+    return BLOCK_HEADER.pack(len(thumb_runs), len(main_runs)) + thumb_runs.tobytes() + main_runs.tobytes()
+
+def runs_block_triplets(block):
+    """Return the number of triplets in a QDR block."""
+    thumb, main = BLOCK_HEADER.unpack_from(block)
+    return thumb + main
+
+class RunsWriter:
+    """Write a QDR file one layer block at a time."""
+
+    def __init__(self, path, header):
+        self.file = open(path, "wb")
+        self.file.write(RUNS_HEADER.pack(RUNS_MAGIC, header.encode()))
+        self.table = []
+
+    def write(self, block):
+        thumb, main = BLOCK_HEADER.unpack_from(block)
+        self.table.append((self.file.tell(), thumb, main))
+        self.file.write(block)
+
+    def close(self):
+        table_offset = self.file.tell()
+        self.file.write(np.array(self.table, dtype="<i8").reshape(-1, 3).tobytes())
+        self.file.write(RUNS_TRAILER.pack(table_offset, len(self.table), RUNS_MAGIC))
+        self.file.close()
+
+class RunsFile:
+    """Memory mapped QDR file.
+
+    layer() returns zero-copy views of the file, so only the pages of the
+    layers actually read are loaded, even for files larger than RAM.
+    """
+
+    def __init__(self, path):
+        self.data = np.memmap(path, dtype=np.uint8, mode="r")
+        magic, header = RUNS_HEADER.unpack_from(self.data)
+        table_offset, self.layers, trailer_magic = RUNS_TRAILER.unpack_from(self.data, len(self.data) - RUNS_TRAILER.size)
+        if magic != RUNS_MAGIC or trailer_magic != RUNS_MAGIC:
+            raise ValueError(f"{path} is not a complete QDR file.")
+        self.header = header.rstrip(b"\0").decode()
+        self.table = np.ndarray((self.layers, 3), dtype="<i8", buffer=self.data, offset=table_offset)
+        self.triplets = int(self.table[:, 1:].sum())
+
+    def layer(self, number):
+        """Return the thumbnail and main runs of layer number, counting from 1."""
+        offset, thumb, main = (int(value) for value in self.table[number - 1])
+        offset += BLOCK_HEADER.size
+        thumb_runs = np.ndarray(thumb, dtype=RUN_DTYPE, buffer=self.data, offset=offset)
+        main_runs = np.ndarray(main, dtype=RUN_DTYPE, buffer=self.data, offset=offset + thumb * RUN_DTYPE.itemsize)
+        return thumb_runs, main_runs
+
+def export_qdx(runs_path, path):
+    """Write the layers of the QDR file runs_path as the standard QDX file path, with its layer index.
+
+    Returns the number of layers, of triplets and the size of the QDX text, before any compression.
+    """
+    with LayerReader(runs_path) as reader, QdxWriter(path, reader.header) as writer:
+        for layer in reader:
+            writer.write(layer)
+    return writer.layers, writer.triplets, writer.size
+
+class QdxFile:
+    """Memory mapped QDX file, read by scanning its bytes for the separators.
+
+    Lines are never decoded: the sections of a layer are zero-copy
+    memoryview slices of the mapping, to be parsed with parse_triplets, so
+    only the pages of the layers actually read are loaded, even for files
+    larger than RAM. A slice keeps the mapping open until it is released.
+
+    A .qdx.gz or .qdx.xz file is read through a CompressedFile instead, its
+    slices are bytes copies of the blocks they fall in. Byte offsets are
+    always those of the decompressed file, as in the layer index.
+
+    Files with "\r\n" line ends, as written on Windows, are read too: their
+    sections are handed out as copies with "\n" line ends.
+    """
+
+    def __init__(self, path):
+        self.blocks = None
+        if compression(path):
+            self.data = self.view = CompressedFile(path)
+            self.blocks = self.data.blocks
+        else:
+            with open(path, "rb") as file:
+                # An empty file can't be mapped
+                self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(path) else b""
+            self.view = memoryview(self.data)
+        end = self.data.find(b"\n")
+        self.start = end + 1 if end >= 0 else len(self.data)
+        self.header = self.text(0, self.start).strip()
+        # The line end of the header is the one of the whole file
+        self.newline = b"\r\n" if end > 0 and self.data[end - 1:end] == b"\r" else b"\n"
+        # The length of the "FB" and "FC" lines, from the offsets of the layer index to the next line
+        self.separator_size = 2 + len(self.newline)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        # The mapping is unmapped once the slices handed out are released too
+        if isinstance(self.data, CompressedFile):
+            self.data.close()
+        self.view = self.data = None
+
+    def layers(self, offset=None):
+        """Yield the layer number and the byte offsets of the counter line, "FB" and "FC" of each complete layer.
+
+        The scan starts at the counter line at offset, by default the first
+        one, and stops at "FD", at a truncated layer or at anything else
+        than a layer counter.
+        """
+        data = self.data
+        newline = self.newline
+        offset = self.start if offset is None else offset
+        while offset < len(data):
+            end = data.find(b"\n", offset)
+            counter = data[offset:end].strip()
+            if end < 0 or not counter.isdigit():
+                break
+            # The line end of the counter line is also the one before "FB" in a layer without thumbnail
+            fb = data.find(newline + b"FB" + newline, end + 1 - len(newline))
+            fc = data.find(newline + b"FC" + newline, fb) if fb >= 0 else -1
+            if fc < 0:
+                break
+            fb, fc = fb + len(newline), fc + len(newline)
+            yield int(counter), offset, fb, fc
+            offset = fc + self.separator_size
+
+    def thumbnail(self, counter, fb):
+        """Return the thumbnail triplets of the layer whose counter line is at counter."""
+        return self.lines(self.view[self.data.find(b"\n", counter) + 1:fb])
+
+    def section(self, fb, fc):
+        """Return the print triplets of the layer between "FB" at fb and "FC" at fc."""
+        return self.lines(self.view[fb + self.separator_size:fc])
+
+    def lines(self, data):
+        # The parsers only know "\n" line ends
+        return data if self.newline == b"\n" else bytes(data).replace(b"\r\n", b"\n")
+
+    def read_layer(self, number, counter, fb, fc, parse=None):
+        """Return the Layer whose counter line, "FB" and "FC" are at counter, fb and fc.
+
+        The sections are parsed with parse, by default read_triplets. Returns
+        None if parse does, e.g. parse_triplets for a section that holds
+        anything but triplets.
+        """
+        parse = parse or read_triplets
+        thumbnail = parse(self.thumbnail(counter, fb))
+        main = parse(self.section(fb, fc))
+        if thumbnail is None or main is None:
+            return None
+        return Layer(number, thumbnail, main)
+
+    def text(self, begin, end):
+        return str(self.view[begin:end], "utf-8")
+
+    def recap(self):
+        """Return the layers and the magic number of the last line, or None if it is missing."""
+        begin = self.data.rfind(b"\n", 0, len(self.data) - 1) + 1
+        fields = self.data[begin:].strip().split(b"|")
+        if len(fields) != 2 or not all(field.isdigit() for field in fields):
+            return None
+        return int(fields[0]), int(fields[1])
+
+def triplet_lines(data):
+    """Parse the "column,count,value" lines of data into three int64 arrays, skipping any other line.
+
+    The line by line counterpart of parse_triplets, for sections that are
+    not only triplets.
+    """
+    numbers = []
+    for line in bytes(data).split(b"\n"):
+        parts = line.strip().split(b",")
+        if len(parts) == 3 and all(part.isdigit() for part in parts):
+            numbers.append([int(part) for part in parts])
+    numbers = np.array(numbers, dtype=np.int64).reshape(-1, 3)
+    return numbers[:, 0], numbers[:, 1], numbers[:, 2]
+
+def read_triplets(data):
+    """Return the triplets of a section with parse_triplets, or with triplet_lines if it holds other lines too."""
+    triplets = parse_triplets(data)
+    return triplet_lines(data) if triplets is None else triplets
+
+def index_path(path):
+    return base_path(path) + compression(path) + ".qdxi"
+
+def scan_index(qdx_file):
+    """Return the INDEX_DTYPE rows of the complete layers of an open QdxFile."""
+    rows = []
+    data = qdx_file.data
+    for counter, offset, fb, fc in qdx_file.layers():
+        # Every line between the counter and "FC" is a triplet, except "FB"
+        rows.append((counter, offset, fb, fc, data[offset:fc].count(b"\n") - 2))
+    return np.array(rows, dtype=INDEX_DTYPE)
+
+def build_index(path):
+    """Scan a QDX file once and return the INDEX_DTYPE rows of its complete layers."""
+    with QdxFile(path) as qdx_file:
+        return scan_index(qdx_file)
+
+def write_index(path, index, blocks=None):
+    """Store index, and the blocks of a compressed file, as the .qdxi sidecar of the QDX file path.
+
+    Returns False if the sidecar could not be written, e.g. in a read only folder.
+    """
+    stat = os.stat(path)
+    sidecar = index_path(path)
+    try:
+        with open(sidecar + ".tmp", "wb") as file:
+            file.write(INDEX_HEADER.pack(INDEX_MAGIC, stat.st_size, stat.st_mtime_ns, len(index)))
+            file.write(index.tobytes())
+            if blocks is not None:
+                file.write(BLOCKS_HEADER.pack(len(blocks)))
+                file.write(np.asarray(blocks, dtype="<i8").tobytes())
+        os.replace(sidecar + ".tmp", sidecar)
+    except OSError:
+        return False
+    return True
+
+def read_sidecar(path):
+    """Return the index and the blocks, None for a file that is not compressed, in the .qdxi sidecar of path.
+
+    Returns None if the sidecar is missing or stale.
+    """
+    stat = os.stat(path)
+    try:
+        with open(index_path(path), "rb") as file:
+            data = file.read()
+    except OSError:
+        return None
+    if len(data) < INDEX_HEADER.size:
+        return None
+    magic, size, mtime_ns, layers = INDEX_HEADER.unpack_from(data)
+    end = INDEX_HEADER.size + layers * INDEX_DTYPE.itemsize
+    if magic != INDEX_MAGIC or (size, mtime_ns) != (stat.st_size, stat.st_mtime_ns) or len(data) < end:
+        return None
+    blocks = None
+    if len(data) > end:
+        count, = BLOCKS_HEADER.unpack_from(data, end) if len(data) >= end + BLOCKS_HEADER.size else (-1,)
+        if len(data) != end + BLOCKS_HEADER.size + count * 16:
+            return None
+        blocks = np.frombuffer(data, dtype="<i8", offset=end + BLOCKS_HEADER.size).reshape(-1, 2)
+    return np.frombuffer(data, dtype=INDEX_DTYPE, count=layers, offset=INDEX_HEADER.size), blocks
+
+def read_index(path):
+    """Return the index in the .qdxi sidecar of path, or None if it is missing or stale."""
+    sidecar = read_sidecar(path)
+    return None if sidecar is None else sidecar[0]
+
+def layer_index(path):
+    """Return the layer index of a QDX file, building and storing it if needed."""
+    index = read_index(path)
+    if index is None:
+        with QdxFile(path) as qdx_file:
+            index = scan_index(qdx_file)
+            write_index(path, index, qdx_file.blocks)
+    return index
+
+def compression(path):
+    """Return the compression suffix of path, ".gz" or ".xz", or "" if it is not compressed."""
+    suffix = os.path.splitext(path)[1]
+    return suffix if suffix in COMPRESSIONS else ""
+
+def base_path(path):
+    """Return path without its compression suffix and its .qdx or .qdr extension."""
+    return os.path.splitext(path[:len(path) - len(compression(path))])[0]
+
+def compress_block(data, suffix):
+    """Return data as a complete gzip member or xz stream."""
+    if suffix == ".gz":
+        return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+    return lzma.compress(data, preset=XZ_PRESET)
+
+def decompress_block(data, suffix):
+    return gzip.decompress(data) if suffix == ".gz" else lzma.decompress(data)
+
+def scan_blocks(path):
+    """Decompress a .gz or .xz file once, and return the (offset, compressed offset) rows of its blocks.
+
+    Every gzip member or xz stream is a block, the last row holds the
+    decompressed and the compressed sizes. A file compressed in one go by
+    another tool is a single block.
+    """
+    suffix = compression(path)
+    blocks = []
+    offset = compressed = 0
+    with open(path, "rb") as file:
+        pending = b""
+        decompressor = None
+        while True:
+            if not pending:
+                pending = file.read(1 << 20)
+                if not pending:
+                    break
+            if decompressor is None:
+                # xz streams may be followed by zero padding
+                padding = len(pending) - len(pending.lstrip(b"\0")) if suffix == ".xz" else 0
+                compressed += padding
+                pending = pending[padding:]
+                if not pending:
+                    continue
+                decompressor = zlib.decompressobj(wbits=31) if suffix == ".gz" else lzma.LZMADecompressor()
+                blocks.append((offset, compressed))
+            offset += len(decompressor.decompress(pending))
+            compressed += len(pending) - len(decompressor.unused_data)
+            pending = decompressor.unused_data
+            if decompressor.eof:
+                decompressor = None
+    if decompressor is not None:
+        raise ValueError(f"{path} is truncated.")
+    blocks.append((offset, compressed))
+    return np.array(blocks, dtype="<i8").reshape(-1, 2)
+
+class CompressedWriter:
+    """Binary file object that compresses what is written to it in independent blocks.
+
+    Every block is a complete gzip member or xz stream of at least
+    block_size bytes, cut between two write() calls, so between two layers
+    for a QdxWriter. The blocks together are a standard .gz or .xz file,
+    and blocks holds where each one starts, to decompress any of them alone.
+    """
+
+    def __init__(self, path, block_size=COMPRESSED_BLOCK_SIZE):
+        self.suffix = compression(path)
+        self.file = open(path, "wb")
+        self.block_size = block_size
+        self.pending = []
+        self.pending_size = 0
+        self.offset = 0
+        self.blocks = []
+
+    def tell(self):
+        """Return the position in the decompressed bytes."""
+        return self.offset + self.pending_size
+
+    def write(self, data):
+        if self.pending_size >= self.block_size:
+            self.flush_block()
+        self.pending.append(bytes(data))
+        self.pending_size += len(data)
+
+    def flush_block(self):
+        if self.pending_size:
+            self.blocks.append((self.offset, self.file.tell()))
+            self.file.write(compress_block(b"".join(self.pending), self.suffix))
+            self.offset += self.pending_size
+            self.pending = []
+            self.pending_size = 0
+
+    def close(self):
+        self.flush_block()
+        self.blocks.append((self.offset, self.file.tell()))
+        self.blocks = np.array(self.blocks, dtype="<i8")
+        self.file.close()
+
+class CompressedFile:
+    """The decompressed bytes of a .gz or .xz QDX file, decompressed one block at a time.
+
+    Supports what QdxFile needs of bytes: len(), slices, find() and rfind().
+    The blocks come from the .qdxi sidecar, or from scan_blocks(). The last
+    blocks used are kept, so that reading the layers in order decompresses
+    each block once. Shared by the request threads of qdxpreview.
+    """
+    cached_blocks = 4
+
+    def __init__(self, path):
+        self.suffix = compression(path)
+        sidecar = read_sidecar(path)
+        self.blocks = sidecar[1] if sidecar is not None and sidecar[1] is not None else scan_blocks(path)
+        self.offsets = self.blocks[:, 0]
+        with open(path, "rb") as file:
+            self.compressed = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(path) else b""
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def close(self):
+        self.cache.clear()
+        if isinstance(self.compressed, mmap.mmap):
+            self.compressed.close()
+
+    def block(self, number):
+        """Return the decompressed bytes of block number."""
+        with self.lock:
+            if number in self.cache:
+                self.cache.move_to_end(number)
+                return self.cache[number]
+        begin, end = int(self.blocks[number, 1]), int(self.blocks[number + 1, 1])
+        data = decompress_block(self.compressed[begin:end], self.suffix)
+        with self.lock:
+            self.cache[number] = data
+            while len(self.cache) > self.cached_blocks:
+                self.cache.popitem(last=False)
+        return data
+
+    def block_at(self, offset):
+        """Return the block holding offset."""
+        return int(np.searchsorted(self.offsets, offset, side="right")) - 1
+
+    def __getitem__(self, key):
+        start, stop, _ = key.indices(len(self))
+        pieces = []
+        number = self.block_at(start)
+        while start < stop:
+            begin = int(self.offsets[number])
+            data = self.block(number)
+            pieces.append(data[start - begin:stop - begin])
+            start = begin + len(data)
+            number += 1
+        return b"".join(pieces)
+
+    def find(self, sub, start=0, end=None):
+        end = len(self) if end is None else min(end, len(self))
+        if start >= end:
+            return -1
+        carry = b""
+        for number in range(self.block_at(start), len(self.offsets) - 1):
+            # The end of the previous block, in case sub straddles the two
+            begin = int(self.offsets[number]) - len(carry)
+            if begin >= end:
+                break
+            chunk = carry + self.block(number)
+            found = chunk.find(sub, max(start - begin, 0), end - begin)
+            if found >= 0:
+                return begin + found
+            carry = chunk[len(chunk) - len(sub) + 1:] if len(sub) > 1 else b""
+        return -1
+
+    def rfind(self, sub, start=0, end=None):
+        end = len(self) if end is None else min(end, len(self))
+        if start >= end:
+            return -1
+        carry = b""
+        for number in range(self.block_at(end - 1), -1, -1):
+            # The start of the next block, in case sub straddles the two
+            begin = int(self.offsets[number])
+            if begin + len(self.block(number)) + len(carry) <= start:
+                break
+            chunk = self.block(number) + carry
+            found = chunk.rfind(sub, max(start - begin, 0), end - begin)
+            if found >= 0:
+                return begin + found
+            carry = chunk[:len(sub) - 1]
+        return -1
+
+class Layer:
+    """The thumbnail and main triplets of a layer.
+
+    Each section is a (rows, lengths, values) tuple of int64 arrays, the
+    columns of its "row,displacement,laser_on" lines.
+    """
+    __slots__ = ("number", "thumbnail", "main")
+
+    def __init__(self, number, thumbnail, main):
+        self.number = number
+        self.thumbnail = thumbnail
+        self.main = main
+
+    @property
+    def triplets(self):
+        return len(self.thumbnail[0]) + len(self.main[0])
+
+    def block(self):
+        """Return the layer as QDX text, from its counter line to "FC"."""
+        return b"".join((f"{self.number}\n".encode(), format_triplets(*self.thumbnail), b"FB\n",
+                         format_triplets(*self.main), b"FC\n"))
+
+def runs_section(runs):
+    """Return RUN_DTYPE runs as a (rows, lengths, values) tuple of int64 arrays."""
+    return tuple(runs[name].astype(np.int64) for name in ("column", "count", "value"))
+
+class LayerReader:
+    """The layers of a QDX file or of a QDR run store, as Layer objects.
+
+    Iterating streams the layers in file order. layer() reads any one of
+    them, through the layer index for a QDX file, so does layers() to
+    reach its first layer.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.runs_file = self.qdx_file = None
+        if path.endswith(".qdr"):
+            self.runs_file = RunsFile(path)
+            self.header = self.runs_file.header
+        else:
+            self.qdx_file = QdxFile(path)
+            self.header = self.qdx_file.header
+        self.index = self.positions = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self.qdx_file is not None:
+            self.qdx_file.close()
+
+    def __iter__(self):
+        return self.layers()
+
+    def __contains__(self, number):
+        if self.runs_file is not None:
+            return 1 <= number <= self.runs_file.layers
+        return number in self.layer_positions()
+
+    @property
+    def numbers(self):
+        """The numbers of the complete layers, in file order."""
+        if self.runs_file is not None:
+            return range(1, self.runs_file.layers + 1)
+        return list(self.layer_positions())
+
+    def layer_positions(self):
+        # The position in the layer index of every layer number, the first one if a number repeats
+        if self.positions is None:
+            self.index = layer_index(self.path)
+            self.positions = {}
+            for position, number in enumerate(self.index["layer"].tolist()):
+                self.positions.setdefault(number, position)
+        return self.positions
+
+    def layers(self, first=1, last=None):
+        """Yield the layers in file order, from the first one numbered first or more, until one past last."""
+        if self.runs_file is not None:
+            stop = self.runs_file.layers if last is None else min(last, self.runs_file.layers)
+            for number in range(max(first, 1), stop + 1):
+                yield self.layer(number)
+            return
+        offset = None
+        if first > 1:
+            self.layer_positions()
+            later = np.flatnonzero(self.index["layer"] >= first)
+            if len(later) == 0:
+                return
+            offset = int(self.index["counter"][later[0]])
+        for number, counter, fb, fc in self.qdx_file.layers(offset):
+            if last is not None and number > last:
+                break
+            yield self.qdx_file.read_layer(number, counter, fb, fc)
+
+    def layer(self, number):
+        """Return the layer numbered number, or None if it is not in the file."""
+        if self.runs_file is not None:
+            if number not in self:
+                return None
+            thumb_runs, main_runs = self.runs_file.layer(number)
+            return Layer(number, runs_section(thumb_runs), runs_section(main_runs))
+        position = self.layer_positions().get(number)
+        if position is None:
+            return None
+        row = self.index[position]
+        return self.qdx_file.read_layer(number, int(row["counter"]), int(row["fb"]), int(row["fc"]))
+
+class QdxWriter:
+    """Write a QDX file one layer at a time, then its FD recap and its layer index on close.
+
+    A path ending with .gz or .xz is compressed in blocks of whole layers.
+
+    file, layers and triplets carry on with a file already open after its
+    last complete layer, to resume an interrupted run.
+    """
+
+    def __init__(self, path, header, file=None, layers=0, triplets=0):
+        self.path = path
+        self.file = file
+        if file is None:
+            self.file = CompressedWriter(path) if compression(path) else open(path, "wb")
+            self.file.write(f"{header}\n".encode())
+        self.layers = layers
+        self.triplets = triplets
+        self.index = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        # An incomplete file gets no recap
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+
+    def write(self, layer):
+        self.write_block(layer.number, layer.block(), layer.triplets)
+
+    def write_block(self, number, block, triplets):
+        """Write the QDX text of layer number, from its counter line to "FC", holding triplets triplets."""
+        offset = self.file.tell()
+        self.index.append((number, offset, offset + block.find(b"\nFB\n") + 1, offset + len(block) - 3, triplets))
+        self.file.write(block)
+        self.layers += 1
+        self.triplets += triplets
+
+    def recap(self):
+        """Return the FD recap of the layers written so far."""
+        return f"FD\n{self.layers}|{self.triplets + self.layers * 2}\n".encode()
+
+    def close(self):
+        self.file.write(self.recap())
+        # The size of the QDX text, also when it is written compressed
+        self.size = self.file.tell()
+        self.file.close()
+        # The offsets of the layers of a resumed file are only known by scanning it again
+        if len(self.index) == self.layers:
+            write_index(self.path, np.array(self.index, dtype=INDEX_DTYPE), getattr(self.file, "blocks", None))
+        else:
+            write_index(self.path, build_index(self.path))
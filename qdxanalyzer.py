@@ -2,9 +2,17 @@ import sys
 import os
 import time
 import shutil
+import io
+import contextlib
+import queue
+import threading
+import subprocess
 import cv2
 import numpy as np
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+import qdx
+from metrics import Metrics
 
 #################################################
 #
@@ -27,48 +35,71 @@ from datetime import datetime
 
 # Record the start time
 start_time = time.time()
+# Stage timings of every layer, recorded with --metrics
+metrics = Metrics()
 
 # Expected values for Galaxy 1
 LH, X, Y, Z = 50, 4000, 8000, 8000  
 expected_header = f"JieHe,{LH},{X},{Y},2,030,0,FA"
 
-c_red = (0, 0, 255)
-c_white = (255, 255, 255)
-
 def help():
     print("QDX Analyzer")
-    print("Usage: python qdxanalyzer.py <filename> <optional end-layer> <optional start-layer>  <optional p|v>")
-    print("     <filename>: the qdx file")
+    print("Usage: python qdxanalyzer.py <filename> <optional end-layer> <optional start-layer>  <optional p|v> <optional -j N>")
+    print("     <filename>: the qdx file, also compressed as .qdx.gz or .qdx.xz, or a qdr run store written by qdxfromPNG.py")
     print(f"     <optional end-layer>: default is {Z}, which is the maximum possible")
     print("     <optional start-layer>: default is 1, which is the beginning of the file")
     print("     <optional p|v>: p indicates pictures, v indicates video, pv indicates both (slower execution)")
     print("                     pictures are stored in a separate folder named after the filename")
     print("                     if omitted only the analisys will be performed")
+    print("     <optional -j N>: check the layers of a qdx file in N worker processes, without pictures or video")
+    print("     <optional --ffmpeg>: create the video by piping the frames to ffmpeg (libx264) instead of OpenCV (mp4v)")
+    print("     <optional --preview>: draw the pictures and video from the 400 x 800 thumbnails, with a contact sheet of the pictures")
+    print("     <optional --cross-check>: report the layers whose thumbnail doesn't match the print")
+    print("     <optional --metrics>: write the stage timings of every layer to <filename>_qdxanalyzer.json and .csv")
     sys.exit(1)
 
 # Prints timestamp and msg
 def vlog(msg):
   print(f"{datetime.fromtimestamp(time.time()-start_time).strftime('%H:%M:%S')} - {msg}")
 
-# Draw a vertical line in the frame buffer
-def draw_segment(current_layer, frame_buffer, row, segment_start, segment_end, color):                                
-    if current_layer %2 == 1: # Every other layer is mirrored
-        cv2.line(frame_buffer, (row, segment_start), (row, segment_end), color, 1)
-    else:
-        cv2.line(frame_buffer, (Y - row, segment_start), (Y - row, segment_end), color, 1)
-
 def read_parameters(argv):
     if len(argv) < 2:
         help()
 
     filename = ""
     start_layer = end_layer =   magic_number = triplets = 0
-    do_video = do_pictures = visuals = False
+    do_video = do_pictures = visuals = ffmpeg = preview = cross_check = report_metrics = False
+    jobs = 1
 
     # Read command line parameters:
-    for index, arg in enumerate(argv[1:]):
+    args = iter(argv[1:])
+    for arg in args:
+        # Number of worker processes
+        if arg in ("-j", "--jobs"):
+            value = next(args, "")
+            if not value.isdigit() or int(value) < 1:
+                print(f"Error: {arg} requires a positive number of jobs.")
+                help()
+            jobs = int(value)
+
+        # Video encoded by ffmpeg
+        elif arg == "--ffmpeg":
+            do_video = ffmpeg = True
+
+        # Pictures and video from the thumbnails
+        elif arg == "--preview":
+            preview = True
+
+        # Thumbnails checked against the print
+        elif arg == "--cross-check":
+            cross_check = True
+
+        # Stage timings of every layer
+        elif arg == "--metrics":
+            report_metrics = True
+
         # Filename
-        if arg.endswith(".qdx"):
+        elif arg.endswith(qdx.QDX_EXTENSIONS + (".qdr",)):
             if os.path.isfile(arg):
                 filename = arg
             else:
@@ -98,21 +129,18 @@ def read_parameters(argv):
         
     # If no end layer is provided on the command line, do the entire file
     # Read the total number of layers from the last line in the file
-    if end_layer == 0:
-        with open(filename, 'rb') as file:
-            # Move the cursor to the second to last byte of the file
-            file.seek(-2, os.SEEK_END)
-            # Keep moving backwards until we find a newline character
-            while file.read(1) != b'\n':
-                file.seek(-2, os.SEEK_CUR)
-            # Read and return the last line
-            last_line = file.readline().decode()
-            if "|" in last_line:
-                end_layer = int(last_line.split("|")[0])
-                magic_number = int(last_line.split("|")[1])
-            else:
-                vlog("Error: missing last line of the file with the total layer number!!!")
-                end_layer = 8000
+    if end_layer == 0 and filename.endswith(".qdr"):
+        runs_file = qdx.RunsFile(filename)
+        end_layer = runs_file.layers
+        magic_number = runs_file.triplets + 2 * runs_file.layers
+    elif end_layer == 0:
+        with qdx.QdxFile(filename) as qdx_file:
+            recap = qdx_file.recap()
+        if recap is not None:
+            end_layer, magic_number = recap
+        else:
+            vlog("Error: missing last line of the file with the total layer number!!!")
+            end_layer = 8000
 
     if start_layer == 0:
         start_layer = 1
@@ -123,14 +151,22 @@ def read_parameters(argv):
     print(f"   End layer:    {end_layer}")
     print(f"   Magic Number: {magic_number}")
     print(f"   Create images:{"yes" if do_pictures else "no"}")
-    print(f"   Create video: {"yes" if do_video else "no"}")
-
-    return filename, start_layer, end_layer, do_video, do_pictures, magic_number, triplets
-
-def main(filename, start_layer, end_layer, do_video, do_pictures, magic_number, triplets):
+    print(f"   Create video: {("yes, with ffmpeg" if ffmpeg else "yes") if do_video else "no"}")
+    print(f"   Preview:      {"yes" if preview else "no"}")
+    print(f"   Cross-check:  {"yes" if cross_check else "no"}")
+    print(f"   Metrics:      {"yes" if report_metrics else "no"}")
+    print(f"   Jobs:         {jobs}")
+
+    return (filename, start_layer, end_layer, do_video, do_pictures, magic_number, triplets, jobs, ffmpeg, preview,
+            cross_check, report_metrics)
+
+def main(filename, start_layer, end_layer, do_video, do_pictures, magic_number, triplets, jobs=1, ffmpeg=False,
+         preview=False, cross_check=False, report_metrics=False):
+    global metrics
+    metrics = Metrics(report_metrics)
     
     visuals = do_pictures or do_video    # only if needed, we will creates and manage the frame buffer
-    dir_path, _ = os.path.splitext(filename)         
+    dir_path = qdx.base_path(filename)
 
     # We want to store the images in a directory
     if do_pictures:
@@ -139,169 +175,555 @@ def main(filename, start_layer, end_layer, do_video, do_pictures, magic_number,
             shutil.rmtree(dir_path)                
         os.makedirs(dir_path, exist_ok=True)
 
-    # We want to create the video
-    if do_video:
-        # Define the codec and create VideoWriter object
-        fourcc = cv2.VideoWriter_fourcc(*'mp4v')  # 'XVID' or 'mp4v'
-        out = cv2.VideoWriter(f"{dir_path}.mp4", fourcc, 24, (Y, X))
-
+    frames = None
+    if visuals and jobs > 1:
+        vlog("Pictures and video are drawn in layer order, the layers are checked in this process")
     if visuals:
-        vlog("Initialize the frame buffer")
-        # Create an empty (black) image
-        frame_buffer = np.zeros((X, Y, 3), dtype=np.uint8)
+        vlog("Initialize the frame buffers")
+        frames = FrameWriter(dir_path, do_pictures, do_video, ffmpeg, preview)
 
     layer_count = 0
     current_layer = 0
-    in_layer = False
     error_layers = []
+    bar = ''
+    line = ''
 
     vlog(f"Opening and reading {filename}...")
-    with open(filename, 'r') as file:
-        first_line = file.readline()
-
-        # Validate header and continue
-        vlog("Validating header...")
-        header = first_line.strip()
-        if header == expected_header:
-            vlog(f"Header is compliant: found {header}")
-        else:
-            vlog(f"!!! Header compliance failed: found {header}")
+    if filename.endswith(".qdr"):
+        # Binary run store: every layer is a slice of the memory mapped file
+        with qdx.LayerReader(filename) as reader:
+            validate_header(reader.header)
+
+            for layer in reader.layers(1, end_layer):
+                current_layer = layer.number
+                triplets = triplets + layer.triplets
+                layer_count += 1
+                if current_layer >= start_layer:
+                    # The runs are read in place and only widened, there is nothing to parse
+                    metrics.add(current_layer, triplets=layer.triplets,
+                                bytes=qdx.BLOCK_HEADER.size + layer.triplets * qdx.RUN_DTYPE.itemsize)
+                    bar = progress_bar(current_layer, start_layer, bar)
+                    if analyze_layer(current_layer, *layer.main, frames, layer.thumbnail, cross_check):
+                        error_layers.append(current_layer)
+        vlog(f"Processing layer {current_layer}")
 
-        # Courtesy message
-        if start_layer > 5:
-            vlog(f"Seeking layer {start_layer}...")
+    else:
+        with qdx.QdxFile(filename) as qdx_file:
+            # Validate header and continue
+            validate_header(qdx_file.header)
+
+            # Courtesy message
+            if start_layer > 5:
+                vlog(f"Seeking layer {start_layer}...")
+
+            # Jump to the start layer with the layer index, the layers before only add to the counts
+            # The layers are skipped by number, not by position, as a missing or repeated layer shifts them
+            index = qdx.layer_index(filename)
+            position = qdx_file.start
+            if start_layer > 1:
+                for layer in index:
+                    if layer["layer"] > end_layer or layer["layer"] >= start_layer:
+                        break
+                    current_layer = int(layer["layer"])
+                    layer_count += 1
+                    if layer_count != current_layer:
+                        vlog(f"Error in layer {current_layer}: layer number doesn't match the sequence {layer_count}")
+                    triplets = triplets + int(layer["triplets"])
+                if layer_count < len(index):
+                    position = int(index["counter"][layer_count])
+                elif layer_count:
+                    # Past the last complete layer, the recap section follows
+                    position = int(index["fc"][layer_count - 1]) + qdx_file.separator_size
+
+            # The layers to check stop at the first one past end_layer, whose number line ends the analysis,
+            # otherwise the lines after the last complete layer do
+            first = layer_count
+            beyond = np.flatnonzero(index["layer"][first:] > end_layer)
+            stop = first + int(beyond[0]) if len(beyond) else len(index)
+            tail = (int(index["fc"][stop - 1]) + qdx_file.separator_size if stop > first else position,
+                    int(index["fb"][stop]) if stop < len(index) else len(qdx_file.data))
+
+            # Let's go!!!
+            if jobs > 1 and not visuals:
+                results = analyze_parallel(filename, index, first, stop, tail, start_layer, end_layer, current_layer, jobs,
+                                           cross_check)
+            else:
+                results = [analyze_span(filename, index[first:stop], tail, start_layer, end_layer, layer_count,
+                                        current_layer, frames, cross_check)]
+            for layer_count, current_layer, chunk_triplets, chunk_errors, chunk_bar, line in results:
+                triplets = triplets + chunk_triplets
+                error_layers += chunk_errors
+                bar = chunk_bar or bar
+
+            # We reached the end of the analysis, so we clean up the progress bar
+            if '|' in line:
+                # In case we reached the actual end of the file
+                print(f'\r[{bar}] {current_layer}', end=' ')
+                vlog(f"Processing layer {current_layer}")
+            else:
+                vlog(f"Processing layer {current_layer-1}")
 
-        # Let's go!!!
-        for line in file:
-            line = line.strip()
+    # Report is there were errors in the file
+    if len(error_layers) > 0:
+        print("!!! Errors in the following layers:", end=" ")
+        print(*error_layers)
+    else:
+        vlog("No errors found in the layers")
 
-            # Found a layer number that starts the respective layer section
-            if line.isdigit():
-                current_layer = int(line)
-                # Exit criteria
-                if current_layer > end_layer:
-                    break
+    vlog(f"current line {line}")
+    # In case we reached the actual end of the file, let's process also the last line with the total number of layers
+    vlog("Validating recap section...")
+    if layer_count == end_layer:
+        vlog(f"Recap is compliant: found {layer_count} layers, as expected.")
+    else:
+        vlog(f"Recap compliance failed: found {layer_count} layers, expected {end_layer}.")
+    if (triplets + 2 * layer_count) == magic_number:
+        vlog(f"Magic Number is compliant: calculated {triplets + 2 * layer_count}, as expected.")
+    else:
+        vlog(f"Magic Number is failed: calculated {triplets + 2 * layer_count}, expected {magic_number}.")
 
-                layer_count += 1
-                if layer_count != current_layer:
-                    vlog(f"Error in layer {current_layer}: layer number doesn't match the sequence {layer_count}")
-            
-            # Start the analysis of the layer image data between "FB" and "FC"
-            elif line == "FB":
-                # If the layer is in the analysis interval, let's get into it
-                if current_layer >= start_layer:
-                    in_layer = True
-                    last_row = -1
-                    segment_end = X
-                    error_flag = False
-                    # Clear the frame buffer (fill it with black)
-                    if visuals:
-                        frame_buffer[:] = [0, 0, 0]
-                    # Progress bar visualization (done once per layer)
-                    if current_layer % 50:
-                        i = current_layer % 50 + 1
-                        iz = start_layer % 50
-                        if current_layer - start_layer <= 50 - iz:
-                            bar = '-' * iz + '#' * (i-iz) + '-' * (50 - i)
-                        else:
-                            bar = '#' * i + '-' * (50 - i)
-                        print(f'\r[{bar}] {current_layer + 1}', end=' ')
-                    else:
-                        vlog(f"Processing layer {current_layer}")
-
-            # End of the analysis of the layer image data between "FB" and "FC"
-            elif line == "FC" and in_layer:
-                in_layer = False
-                
-                if error_flag:
-                    # This layer had a slicing issue, add it to the list
-                    error_layers.append(current_layer)
-                    error_flag = False
-                if visuals:
-                    # Stamp the layer number on the frame
-                    cv2.putText(frame_buffer, f"{current_layer}", (100,300), cv2.FONT_HERSHEY_SIMPLEX, 10, (255,255,255), 20)
-                    if do_pictures:
-                        # Dump the image in the directory
-                        cv2.imwrite(f"{dir_path}/layer{current_layer}.png", frame_buffer)
-                    if do_video:
-                        # add the frame to the video
-                        out.write(frame_buffer)
 
-            # Reached end of the file, exit the loop
-            elif line == "FD":
+    # Wrap up
+    if frames is not None:
+        frames.close()
+    if do_video:
+        vlog(f"Video {dir_path}.mp4 released")
+    if do_pictures:
+        vlog(f"Pictures available in the {dir_path} folder")
+    metrics_file = metrics.write(filename, "qdxanalyzer")
+    if metrics_file:
+        vlog(f"Metrics in {metrics_file}")
+
+def validate_header(header):
+    vlog("Validating header...")
+    if header == expected_header:
+        vlog(f"Header is compliant: found {header}")
+    else:
+        vlog(f"!!! Header compliance failed: found {header}")
+
+# Progress bar visualization (done once per layer)
+def progress_bar(current_layer, start_layer, bar):
+    if current_layer % 50:
+        i = current_layer % 50 + 1
+        iz = start_layer % 50
+        if current_layer - start_layer <= 50 - iz:
+            bar = '-' * iz + '#' * (i-iz) + '-' * (50 - i)
+        else:
+            bar = '#' * i + '-' * (50 - i)
+        print(f'\r[{bar}] {current_layer + 1}', end=' ')
+    else:
+        vlog(f"Processing layer {current_layer}")
+    return bar
+
+# Check the layers in lines, from a layer number line on, until "FD" or a layer past end_layer
+# Returns the layer count, the last layer number, the triplets, the layers with errors,
+# the progress bar and the last line read
+def analyze_lines(lines, start_layer, end_layer, layer_count, current_layer, frames, cross_check=False):
+    triplets = 0
+    in_layer = in_thumbnail = False
+    thumbnail = [], [], []
+    layer_since, layer_triplets = time.perf_counter(), 0
+    error_layers = []
+    bar = ''
+    line = ''
+
+    # Check the rows of the layer between "FB" and "FC", or up to where its missing "FC" should be
+    def check_section(missing_fc=False):
+        if missing_fc:
+            print(f"\nError in layer {current_layer}: missing FC")
+        # A layer has a line for its number, FB and FC besides the triplets
+        metrics.add(current_layer, parse=time.perf_counter() - layer_since, triplets=triplets - layer_triplets,
+                    lines=triplets - layer_triplets + 3)
+        if analyze_layer(current_layer, rows, segment_lengths, laser_ons, frames, thumbnail, cross_check) or missing_fc:
+            # This layer had a slicing issue, add it to the list
+            error_layers.append(current_layer)
+
+    for line in lines:
+        line = line.strip()
+
+        # The next layer, or the end of the file, came before "FC": the layer is checked all the same
+        if in_layer and (line.isdigit() or line in ("FB", "FD")):
+            in_layer = False
+            check_section(missing_fc=True)
+
+        # Found a layer number that starts the respective layer section
+        if line.isdigit():
+            current_layer = int(line)
+            # Exit criteria
+            if current_layer > end_layer:
                 break
 
-            # Core layer processing (we are between FB and FC)
-            else:
-                triplets = triplets + 1
-                if in_layer:
-                    # Split the data triplet in the line
-                    parts = line.split(',')
-                    if len(parts) == 3:  # segment data line
-                        row, segment_length, laser_on = map(int, parts)
-
-                        # If this is a new Y row
-                        if row != last_row:
-                            # Check if the previous Y segment was too short
-                            if segment_end < X:
-                                print(f"\nError in layer {current_layer}: row {row} is too short. Laser X gets up to {segment_end}")
-                                error_flag = True
-                                if visuals:
-                                    draw_segment(current_layer, frame_buffer, last_row, segment_start, X, c_red)
-                            # Reset parameters for the new line
-                            segment_start = 0
-                        
-                        # X coordinate end of the segment to draw
-                        segment_end = segment_start + segment_length
-
-                        if segment_end > X:
-                            # Segment exceeds X maximum value?
-                            print(f"\nError in layer {current_layer}: row {row} exceeds limits. Laser X gets up to {segment_end}")
-                            error_flag = True
-                            if visuals:
-                                draw_segment(current_layer, frame_buffer, row, segment_start, X, c_red)
-                        else:
-                            # Draw the line if the laser is on
-                            if visuals and laser_on == 1:
-                                draw_segment(current_layer, frame_buffer, row, segment_start, segment_end, c_white)
-
-                        last_row = row 
-                        segment_start = segment_end
-
-        # We reached the end of the analysis, so we clean up the progress bar
-        if '|' in line:
-            # In case we reached the actual end of the file
-            print(f'\r[{bar}] {current_layer}', end=' ')
-            vlog(f"Processing layer {current_layer}")
-        else:
-            vlog(f"Processing layer {current_layer-1}")
+            layer_count += 1
+            if layer_count != current_layer:
+                vlog(f"Error in layer {current_layer}: layer number doesn't match the sequence {layer_count}")
+            # The thumbnail comes first
+            in_thumbnail = True
+            thumbnail = [], [], []
+            layer_since, layer_triplets = time.perf_counter(), triplets
+    
+        # Start the analysis of the layer image data between "FB" and "FC"
+        elif line == "FB":
+            in_thumbnail = False
+            # If the layer is in the analysis interval, let's get into it
+            if current_layer >= start_layer:
+                in_layer = True
+                rows, segment_lengths, laser_ons = [], [], []
+                bar = progress_bar(current_layer, start_layer, bar)
+
+        # End of the analysis of the layer image data between "FB" and "FC"
+        elif line == "FC":
+            if in_layer:
+                in_layer = False
+                check_section()
 
-        # Report is there were errors in the file
-        if len(error_layers) > 0:
-            print("!!! Errors in the following layers:", end=" ")
-            print(*error_layers)
-        else:
-            vlog("No errors found in the layers")
+        # Reached end of the file, exit the loop
+        elif line == "FD":
+            break
 
-        vlog(f"current line {line}")
-        # In case we reached the actual end of the file, let's process also the last line with the total number of layers
-        vlog("Validating recap section...")
-        if layer_count == end_layer:
-            vlog(f"Recap is compliant: found {layer_count} layers, as expected.")
-        else:
-            vlog(f"Recap compliance failed: found {layer_count} layers, expected {end_layer}.")
-        if (triplets + 2 * layer_count) == magic_number:
-            vlog(f"Magic Number is compliant: calculated {triplets + 2 * layer_count}, as expected.")
+        # Core layer processing (we are between FB and FC)
         else:
-            vlog(f"Magic Number is failed: calculated {triplets + 2 * layer_count}, expected {magic_number}.")
-
+            triplets = triplets + 1
+            if in_layer or in_thumbnail:
+                # Split the data triplet in the line
+                parts = line.split(',')
+                # A line cut short, as an interrupted encode leaves the last one, is only counted
+                if len(parts) == 3 and all(part.isdigit() for part in parts):  # segment data line
+                    row, segment_length, laser_on = map(int, parts)
+                    columns = (rows, segment_lengths, laser_ons) if in_layer else thumbnail
+                    columns[0].append(row)
+                    columns[1].append(segment_length)
+                    columns[2].append(laser_on)
+    # The lines ended within a layer, as in a truncated file
+    if in_layer:
+        check_section(missing_fc=True)
+    return layer_count, current_layer, triplets, error_layers, bar, line
+
+# Check the complete layers of the index rows in layers, parsing each section in one step,
+# then the lines between the byte offsets of tail, if any, which end the analysis
+# Returns the same as analyze_lines
+def analyze_span(filename, layers, tail, start_layer, end_layer, layer_count, current_layer, frames, cross_check=False):
+    triplets = 0
+    error_layers = []
+    bar = ''
+    line = ''
+    with qdx.QdxFile(filename) as qdx_file:
+        for layer in layers:
+            counter, fb, fc = int(layer["counter"]), int(layer["fb"]), int(layer["fc"])
+            with metrics.stage(int(layer["layer"]), "parse"):
+                parsed = qdx_file.read_layer(int(layer["layer"]), counter, fb, fc, qdx.parse_triplets)
+            if parsed is None:
+                # Not only triplets between the separators, leave it to the line parser
+                layer_count, current_layer, layer_triplets, layer_errors, layer_bar, line = analyze_lines(
+                    qdx_file.text(counter, fc + qdx_file.separator_size).splitlines(), start_layer, end_layer,
+                    layer_count, current_layer, frames, cross_check)
+                triplets = triplets + layer_triplets
+                error_layers += layer_errors
+                bar = layer_bar or bar
+                continue
+
+            current_layer = int(layer["layer"])
+            layer_count += 1
+            if layer_count != current_layer:
+                vlog(f"Error in layer {current_layer}: layer number doesn't match the sequence {layer_count}")
+            triplets = triplets + int(layer["triplets"])
+            if current_layer >= start_layer:
+                metrics.add(current_layer, triplets=int(layer["triplets"]), lines=int(layer["triplets"]) + 3,
+                            bytes=fc + qdx_file.separator_size - counter)
+                bar = progress_bar(current_layer, start_layer, bar)
+                if analyze_layer(current_layer, *parsed.main, frames, parsed.thumbnail, cross_check):
+                    error_layers.append(current_layer)
 
-        # Wrap up
-        if do_video:
-            out.release()
-            vlog(f"Video {dir_path}.mp4 released")
-        if do_pictures:
-            vlog(f"Pictures available in the {dir_path} folder")
+        if tail is not None:
+            layer_count, current_layer, tail_triplets, tail_errors, tail_bar, line = analyze_lines(
+                qdx_file.text(*tail).splitlines(), start_layer, end_layer, layer_count, current_layer, frames,
+                cross_check)
+            triplets = triplets + tail_triplets
+            error_layers += tail_errors
+            bar = tail_bar or bar
+    return layer_count, current_layer, triplets, error_layers, bar, line
+
+# Split the layers from first to stop in chunks of whole layers with about the same number of bytes,
+# and check them in jobs worker processes
+# Every chunk prints into its own buffer, and the buffers are printed in layer order,
+# so the report is the same as the one of a serial run
+# A chunk starts from the counts of the index rows before it: when the chunk before ends with others,
+# as after a malformed layer left to the line parser, the layers from there are checked again serially
+def analyze_parallel(filename, index, first, stop, tail, start_layer, end_layer, current_layer, jobs, cross_check=False):
+    # Four chunks per worker even out the layers of different sizes
+    begin = int(index["counter"][first]) if stop > first else tail[0]
+    targets = np.linspace(begin, tail[0], 4 * jobs + 1)[1:-1]
+    cuts = np.unique(np.searchsorted(index["counter"][first:stop], targets) + first)
+    bounds = [first] + [int(cut) for cut in cuts if first < cut < stop] + [stop]
+
+    vlog(f"Checking {len(bounds) - 1} chunks with {jobs} worker processes")
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        chunks = []
+        for chunk_first, chunk_stop in zip(bounds[:-1], bounds[1:]):
+            previous_layer = current_layer if chunk_first == first else int(index["layer"][chunk_first - 1])
+            chunks.append(executor.submit(analyze_chunk, filename, index[chunk_first:chunk_stop],
+                                          tail if chunk_stop == stop else None, start_layer, end_layer,
+                                          chunk_first, previous_layer, cross_check, metrics.enabled))
+        for chunk, chunk_stop in zip(chunks, bounds[1:]):
+            output, result, layers = chunk.result()
+            print(output, end='')
+            metrics.merge(layers)
+            yield result
+            layer_count, current_layer = result[:2]
+            if chunk_stop < stop and (layer_count, current_layer) != (chunk_stop, int(index["layer"][chunk_stop - 1])):
+                for later in chunks:
+                    later.cancel()
+                yield analyze_span(filename, index[chunk_stop:stop], tail, start_layer, end_layer, layer_count,
+                                   current_layer, None, cross_check)
+                return
+
+# Worker process side of analyze_parallel, also returns the layer records of its metrics
+def analyze_chunk(filename, layers, tail, start_layer, end_layer, layer_count, current_layer, cross_check,
+                  report_metrics):
+    global metrics
+    metrics = Metrics(report_metrics)
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        result = analyze_span(filename, layers, tail, start_layer, end_layer, layer_count, current_layer,
+                              None, cross_check)
+    return output.getvalue(), result, metrics.layers
+
+# Check the segments of a layer between "FB" and "FC", and output its frame if there is a frame buffer
+# Returns True if the layer has slicing errors
+# thumbnail holds the triplets before "FB", drawn instead of the layer in preview frames
+def analyze_layer(current_layer, rows, segment_lengths, laser_ons, frames, thumbnail=None, cross_check=False):
+    rows = np.asarray(rows, dtype=np.int64)
+    segment_lengths = np.asarray(segment_lengths, dtype=np.int64)
+    with metrics.stage(current_layer, "check"):
+        error_flag = check_layer(current_layer, rows, segment_lengths)
+
+    if cross_check and thumbnail is not None:
+        with metrics.stage(current_layer, "cross_check"):
+            mismatches = cross_check_thumbnail(rows, segment_lengths, laser_ons, thumbnail)
+        if mismatches:
+            print(f"\nError in layer {current_layer}: {mismatches} thumbnail pixels don't match the print")
+            error_flag = True
+
+    if frames is not None:
+        frame_buffer = frames.frame()
+        with metrics.stage(current_layer, "render"):
+            if frames.preview:
+                render_layer(current_layer, *thumbnail, frame_buffer)
+            else:
+                render_layer(current_layer, rows, segment_lengths, laser_ons, frame_buffer)
+        frames.write(current_layer, frame_buffer)
+    return error_flag
+
+# Draw a layer in frame_buffer, full size or thumbnail size, and stamp its number on it
+def render_layer(current_layer, rows, segment_lengths, laser_ons, frame_buffer):
+    rows, segment_lengths, laser_ons = (np.asarray(values, dtype=np.int64) for values in (rows, segment_lengths, laser_ons))
+    draw_layer(current_layer, rows, segment_lengths, laser_ons, frame_buffer)
+    # Stamp the layer number on the frame, scaled to the frame
+    scale = frame_buffer.shape[0] // (X // 10)
+    cv2.putText(frame_buffer, f"{current_layer}", (10 * scale, 30 * scale), cv2.FONT_HERSHEY_SIMPLEX, scale,
+                (255,255,255), 2 * scale)
+
+# Every row is checked with the running sum of its segments, and only the offending rows are reported
+# Returns True if the layer has slicing errors
+def check_layer(current_layer, rows, segment_lengths):
+    if len(rows) == 0:
+        return False
+    row_starts, segment_ends = qdx.segment_bounds(rows, segment_lengths)
+    row_ends = segment_ends[np.append(row_starts[1:], len(rows)) - 1]
+
+    # A row short of X is reported at the first segment of the next row
+    errors = [(row_starts[i + 1], 0, f"row {rows[row_starts[i + 1]]} is too short. Laser X gets up to {row_ends[i]}")
+              for i in np.flatnonzero(row_ends[:-1] < X)]
+    errors += [(i, 1, f"row {rows[i]} exceeds limits. Laser X gets up to {segment_ends[i]}")
+               for i in np.flatnonzero(segment_ends > X)]
+    for _, _, error in sorted(errors):
+        print(f"\nError in layer {current_layer}: {error}")
+    return len(errors) > 0
+
+# Draw a layer in the frame buffer from its runs, without a drawing call per segment
+# Every row of the layer is a column of the frame: its runs are expanded into a single channel
+# plane of labels, white where the laser is on, then red over the segments past the frame height
+# and over the rows short of it, and the plane is colored in one step
+def draw_layer(current_layer, rows, segment_lengths, laser_ons, frame_buffer):
+    height, width = frame_buffer.shape[:2]
+    # The plane holds the frame transposed, so that every frame column is a contiguous row
+    plane = np.zeros((width, height), dtype=np.uint8)
+    if len(rows):
+        row_starts, segment_ends, white, labels = expand_runs(rows, segment_lengths, laser_ons, height)
+        row_stops = np.append(row_starts[1:], len(rows))
+        row_ends = segment_ends[row_stops - 1]
+        segment_starts = segment_ends - segment_lengths
+        segment_rows = np.repeat(np.arange(len(row_starts)), row_stops - row_starts)
+
+        # A white line also covers its end point
+        ends_on = np.flatnonzero(white & (segment_ends < height))
+        labels[segment_rows[ends_on], segment_ends[ends_on]] = 1
+
+        for i in np.flatnonzero((segment_ends > height) & (segment_starts < height)):
+            labels[segment_rows[i], segment_starts[i]:] = 2
+        for i in np.flatnonzero(row_ends[:-1] < height):
+            labels[i, row_ends[i]:] = 2
+
+        # Every other layer is mirrored
+        columns = rows[row_starts] if current_layer % 2 == 1 else width - rows[row_starts]
+        inside = (columns >= 0) & (columns < width)
+        place_rows(plane, columns[inside], labels[inside])
+
+    # White is lit on the three channels, red only on the last one
+    labels = cv2.transpose(plane)
+    white = cv2.compare(labels, 1, cv2.CMP_EQ)
+    cv2.merge([white, white, cv2.compare(labels, 0, cv2.CMP_GT)], dst=frame_buffer)
+
+# Expand the runs of a layer with np.repeat into one row of labels per layer row, 1 where
+# the laser is on, with the runs clipped to height and a 0 run up to height after the last one
+# Returns the index of the first segment of every row, the segment ends, the lit segments
+# and the labels
+def expand_runs(rows, segment_lengths, laser_ons, height):
+    row_starts, segment_ends = qdx.segment_bounds(rows, segment_lengths)
+    row_stops = np.append(row_starts[1:], len(rows))
+    row_ends = segment_ends[row_stops - 1]
+    segment_starts = segment_ends - segment_lengths
+    white = (laser_ons == 1) & (segment_ends <= height)
+    run_lengths = np.minimum(segment_ends, height) - np.minimum(segment_starts, height)
+    labels = np.repeat(np.insert(white, row_stops, False).astype(np.uint8),
+                       np.insert(run_lengths, row_stops, height - np.minimum(row_ends, height))).reshape(-1, height)
+    return row_starts, segment_ends, white, labels
+
+# Compare the thumbnail with the print: every thumbnail pixel stands for 10 x 10 print pixels,
+# and a margin of one thumbnail pixel leaves room for the resize filter of the encoder
+# Returns the number of thumbnail pixels lit where the print is empty all around,
+# or dark where the print is full all around
+# Some slicers mirror the print of the even layers but not their thumbnail, so the thumbnail
+# is also compared mirrored, and the orientation that fits best is kept
+def cross_check_thumbnail(rows, segment_lengths, laser_ons, thumbnail):
+    print_pixels = occupancy(rows, segment_lengths, laser_ons, X, Y)
+    thumb_pixels = occupancy(*thumbnail, X // 10, Y // 10)
+    lit = print_pixels.reshape(Y // 10, 10, X // 10, 10).sum(axis=(1, 3), dtype=np.int32)
+    around = np.ones((3, 3), dtype=np.uint8)
+    empty_around = cv2.dilate((lit > 0).astype(np.uint8), around) == 0
+    full_around = cv2.erode((lit == 100).astype(np.uint8), around) == 1
+    # Column c of the thumbnail is drawn mirrored at Y // 10 - c
+    mirrored = np.roll(thumb_pixels[::-1], 1, axis=0)
+    return min(int((pixels & empty_around).sum() + (~pixels & full_around).sum()) for pixels in (thumb_pixels, mirrored))
+
+# The pixels where the laser is on, one row per layer row, without mirroring
+def occupancy(rows, segment_lengths, laser_ons, height, width):
+    plane = np.zeros((width, height), dtype=np.uint8)
+    rows, segment_lengths = np.asarray(rows, dtype=np.int64), np.asarray(segment_lengths, dtype=np.int64)
+    if len(rows):
+        row_starts, _, _, labels = expand_runs(rows, segment_lengths, np.asarray(laser_ons), height)
+        columns = rows[row_starts]
+        place_rows(plane, columns[columns < width], labels[columns < width])
+    return plane > 0
+
+# Copy the labels to the rows columns of plane
+def place_rows(plane, columns, labels):
+    if len(np.unique(columns)) < len(columns):
+        # A row found twice in the layer keeps the pixels of both, red over white
+        np.maximum.at(plane, columns, labels)
+    else:
+        plane[columns] = labels
+
+# Output stage of the frames: the pictures and the video are encoded by a thread of its own,
+# so that encoding a frame overlaps with parsing and drawing the next ones
+# The frames go around a pool of frame buffers, which bounds the frames waiting to be encoded
+# With preview, the frames are the size of the thumbnails, and the pictures are also tiled in a contact sheet
+class FrameWriter:
+    queued_frames = 2
+    sheet_columns = 10
+
+    def __init__(self, dir_path, do_pictures, do_video, ffmpeg, preview=False):
+        self.dir_path = dir_path
+        self.do_pictures = do_pictures
+        self.preview = preview
+        self.out = self.ffmpeg = self.error = None
+        height, width = (X // 10, Y // 10) if preview else (X, Y)
+        self.tiles = [] if preview and do_pictures else None
+        if do_video and ffmpeg:
+            # Raw frames on the standard input of ffmpeg, no intermediate pictures
+            command = ["ffmpeg", "-y", "-loglevel", "error", "-f", "rawvideo", "-pix_fmt", "bgr24",
+                       "-s", f"{width}x{height}", "-framerate", "24", "-i", "-", "-c:v", "libx264", "-pix_fmt", "yuv420p",
+                       f"{dir_path}.mp4"]
+            try:
+                self.ffmpeg = subprocess.Popen(command, stdin=subprocess.PIPE)
+            except FileNotFoundError:
+                vlog("Error: ffmpeg was not found, the video is encoded with OpenCV")
+        if do_video and self.ffmpeg is None:
+            # Define the codec and create VideoWriter object
+            fourcc = cv2.VideoWriter_fourcc(*'mp4v')  # 'XVID' or 'mp4v'
+            self.out = cv2.VideoWriter(f"{dir_path}.mp4", fourcc, 24, (width, height))
+
+        self.free = queue.Queue()
+        for _ in range(self.queued_frames + 1):
+            self.free.put(np.zeros((height, width, 3), dtype=np.uint8))
+        self.pending = queue.Queue()
+        self.frames = 0
+        self.waiting = self.encoding = 0.0
+        self.start = time.perf_counter()
+        self.thread = threading.Thread(target=self.encode, daemon=True)
+        self.thread.start()
+
+    # A free frame buffer to draw in, once the encoder is done with it
+    def frame(self):
+        waiting_since = time.perf_counter()
+        frame_buffer = self.free.get()
+        self.waiting += time.perf_counter() - waiting_since
+        if self.error is not None:
+            raise self.error
+        return frame_buffer
+
+    def write(self, current_layer, frame_buffer):
+        self.pending.put((current_layer, frame_buffer))
+
+    def encode(self):
+        while (item := self.pending.get()) is not None:
+            current_layer, frame_buffer = item
+            encoding_since = time.perf_counter()
+            try:
+                with metrics.stage(current_layer, "pictures"):
+                    if self.error is None and self.do_pictures:
+                        # Dump the image in the directory
+                        cv2.imwrite(f"{self.dir_path}/layer{current_layer}.png", frame_buffer)
+                    if self.error is None and self.tiles is not None:
+                        self.tiles.append(cv2.resize(frame_buffer, None, fx=0.25, fy=0.25, interpolation=cv2.INTER_AREA))
+                with metrics.stage(current_layer, "video"):
+                    if self.error is None and self.out is not None:
+                        # add the frame to the video
+                        self.out.write(frame_buffer)
+                    if self.error is None and self.ffmpeg is not None:
+                        self.ffmpeg.stdin.write(frame_buffer.data)
+            except Exception as error:
+                # Raised on the drawing side with the next frame, and no more frames are encoded
+                self.error = error
+            self.encoding += time.perf_counter() - encoding_since
+            self.frames += 1
+            self.free.put(frame_buffer)
+
+    # Encode the frames still queued, and report the frames per second of both stages
+    def close(self):
+        self.pending.put(None)
+        self.thread.join()
+        if self.out is not None:
+            self.out.release()
+        if self.ffmpeg is not None:
+            self.ffmpeg.stdin.close()
+            self.ffmpeg.wait()
+        if self.error is not None:
+            raise self.error
+        if self.tiles:
+            self.contact_sheet()
+        elapsed = time.perf_counter() - self.start
+        if self.frames:
+            vlog(f"{self.frames} frames in {elapsed:.1f} s, {self.frames / elapsed:.1f} fps: "
+                 f"rendering {self.frames / max(elapsed - self.waiting, 1e-9):.1f} fps, "
+                 f"encoding {self.frames / max(self.encoding, 1e-9):.1f} fps")
+
+    # The preview pictures side by side, sheet_columns per row, in layer order
+    def contact_sheet(self):
+        blank = np.zeros_like(self.tiles[0])
+        self.tiles += [blank] * (-len(self.tiles) % self.sheet_columns)
+        rows = [np.hstack(self.tiles[i:i + self.sheet_columns]) for i in range(0, len(self.tiles), self.sheet_columns)]
+        cv2.imwrite(f"{self.dir_path}/contact_sheet.png", np.vstack(rows))
+        vlog(f"Contact sheet {self.dir_path}/contact_sheet.png written")
 
 if __name__ == "__main__":
 
@@ -1,12 +1,52 @@
 import sys
 import os
+import io
 import time
+import hashlib
+import struct
+from collections import Counter, deque
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from PIL import Image
 import numpy as np
+import qdx
+from qdx import triplets_size
+from metrics import Metrics, peak_rss_mb
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# Rows thresholded at a time, and columns scanned at a time by the encoder
+THRESHOLD_BAND = 256
+RUNS_BLOCK = 256
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# Bump when the encoder output changes, so that old cached blocks are ignored
+CACHE_VERSION = 1
+
+# Persistent per-process buffers, reused from one layer to the next
+frame_buffers = {}
+frame_regions = {}
+# Packed bitmaps and encoded body of the last layer encoded by this process
+previous_layer = {}
 
 def help():
-    print("Usage: script.py [-c] [layer_height] <png_folder>")
-    print("       -c OPTIONAL, check only, no output file generated")
+    print("Usage: script.py [-c] [--jobs N] [-o output_file] [layer_height] <png_folder>")
+    print("       script.py --export <runs_file> [-o output_file]")
+    print("       -c OPTIONAL, check only, no output file generated: prints the triplets and bytes")
+    print("          of every layer, the FD recap and the size of the qdx file that would be written")
+    print("       --jobs N OPTIONAL, encode layers in N worker processes (default 1)")
+    print("       -o output_file OPTIONAL, default is <png_folder>.qdx")
+    print("          a .qdr extension writes the compact binary run store instead of QDX text,")
+    print("          a .qdx.gz or .qdx.xz extension compresses the QDX text in blocks of whole layers")
+    print("       --export <runs_file> converts a .qdr run store to standard QDX")
+    print("       --cache DIR OPTIONAL, reuse the encoded layers stored in DIR")
+    print("       --cache-size MB OPTIONAL, size cap of the cache (default 2048)")
+    print("       --pil-thumbnail OPTIONAL, resize the thumbnail with PIL instead of reducing the main bitmap")
+    print("       --resume OPTIONAL, continue an interrupted run from the last layer recorded in <output_file>.journal")
+    print("       --metrics OPTIONAL, write the stage timings of every layer to <output_file>_qdxfromPNG.json and .csv")
     print("       layer_height OPTIONAL")
     print("       <png_folder> REQUIRED")
     sys.exit(1)
@@ -25,9 +65,18 @@ def read_parameters(argv):
     layer_height = 50
     png_folder = ""
     check_only = False
+    jobs = 1
+    output_file = ""
+    cache_dir = ""
+    cache_size = 2048
+    pil_thumbnail = False
+    resume = False
+    export_file = ""
+    report_metrics = False
 
     # Read command line parameters:
-    for index, arg in enumerate(argv[1:]):
+    args = iter(argv[1:])
+    for arg in args:
         
         # layer_height
         if arg.isdigit():
@@ -36,6 +85,53 @@ def read_parameters(argv):
         # Found a visualization to generate
         elif "-c" == arg:
             check_only = True
+
+        # Number of worker processes
+        elif arg in ("-j", "--jobs"):
+            value = next(args, "")
+            if not value.isdigit() or int(value) < 1:
+                print(f"Error: {arg} requires a positive number of jobs.")
+                help()
+            jobs = int(value)
+
+        # Output file
+        elif arg in ("-o", "--output"):
+            output_file = next(args, "")
+            if output_file == "":
+                print(f"Error: {arg} requires a file name.")
+                help()
+
+        # Layer cache
+        elif arg == "--cache":
+            cache_dir = next(args, "")
+            if cache_dir == "":
+                print(f"Error: {arg} requires a directory.")
+                help()
+        elif arg == "--cache-size":
+            value = next(args, "")
+            if not value.isdigit():
+                print(f"Error: {arg} requires a size in MB.")
+                help()
+            cache_size = int(value)
+
+        # Thumbnail from a PIL resize of the PNG, as in the first versions
+        elif arg == "--pil-thumbnail":
+            pil_thumbnail = True
+
+        # Continue an interrupted run
+        elif arg == "--resume":
+            resume = True
+
+        # Stage timings of every layer
+        elif arg == "--metrics":
+            report_metrics = True
+
+        # Convert a run store to QDX
+        elif arg == "--export":
+            export_file = next(args, "")
+            if not os.path.isfile(export_file):
+                print(f"Error: The file '{export_file}' was not found.")
+                help()
          
         # Filename
         elif os.path.isdir(arg):
@@ -44,120 +140,563 @@ def read_parameters(argv):
             print(f"Error: The directory '{arg}' was not found.")
             help()
 
-    if png_folder == "":
+    if png_folder == "" and export_file == "":
         help()     
+
+    if output_file == "":
+        output_file = os.path.splitext(export_file)[0] + ".qdx" if export_file else os.path.normpath(png_folder) + ".qdx"
             
     print(f"Running {sys.argv[0]} with the following parameters:")
-    print(f"   Input folder: {png_folder}")
+    if export_file:
+        print(f"   Input runs:   {export_file}")
+    else:
+        print(f"   Input folder: {png_folder}")
+    print(f"   Output file:  {output_file}")
     print(f"   Layer heoght: {layer_height}")
     print(f"   Check only:   {check_only}")
+    print(f"   Jobs:         {jobs}")
+    print(f"   Layer cache:  {f'{cache_dir} ({cache_size} MB)' if cache_dir else 'none'}")
+    print(f"   Thumbnail:    {'PIL resize' if pil_thumbnail else 'reduced from the main bitmap'}")
+    print(f"   Resume:       {resume}")
+    print(f"   Metrics:      {report_metrics}")
 
-    return layer_height, png_folder, check_only
+    return (layer_height, png_folder, check_only, jobs, output_file, cache_dir, cache_size, pil_thumbnail, resume,
+            export_file, report_metrics)
 
 
 def validate_png_files(folder_path):
     vlog("Check that all files in the folder are PNGs with the same dimensions.")
-    png_files = [f for f in os.listdir(folder_path) if f.endswith('.png')]
-    if not png_files:
+    names = sorted(os.listdir(folder_path))
+    if not any(name.lower().endswith('.png') for name in names):
         raise ValueError("No PNG files found in the specified folder.")
-    
-    first_image = Image.open(os.path.join(folder_path, png_files[0]))
-    first_size = first_image.size
-    for file in png_files[1:]:
-        image = Image.open(os.path.join(folder_path, file))
-        if image.size != first_size:
-            raise ValueError("PNG files have differing dimensions.")
+
+    # Only the IHDR chunk is read, from several files at a time
+    paths = [os.path.join(folder_path, name) for name in names]
+    with ThreadPoolExecutor(max_workers=min(32, len(paths))) as executor:
+        sizes = list(executor.map(png_size, paths))
+
+    png_files = []
+    problems = []
+    first_size = None
+    for name, size in zip(names, sizes):
+        if not name.lower().endswith('.png') or size is None:
+            problems.append(f"{name}: not a PNG file")
+            continue
+        if first_size is None:
+            first_size = size
+        elif size != first_size:
+            problems.append(f"{name}: {size[0]}x{size[1]} instead of {first_size[0]}x{first_size[1]}")
+        png_files.append(name)
+    if problems:
+        for problem in problems:
+            vlog(f"   {problem}")
+        raise ValueError(f"{len(problems)} files in {folder_path} are not PNGs with the same dimensions.")
+    vlog(f"{len(png_files)} PNG files of {first_size[0]}x{first_size[1]} pixels.")
     return png_files, first_size
 
-def process_images(png_folder, png_files, layer_height, png_dimensions, check_only):
+def png_size(path):
+    """Return the (width, height) found in the IHDR chunk of a PNG, or None if path is not a PNG."""
+    try:
+        with open(path, "rb") as png:
+            header = png.read(24)
+    except OSError:
+        return None
+    # 8 bytes signature, then the IHDR chunk: length, type, width and height
+    if len(header) < 24 or header[:8] != PNG_SIGNATURE or header[12:16] != b"IHDR":
+        return None
+    return struct.unpack(">II", header[16:24])
+
+def process_images(png_folder, png_files, layer_height, png_dimensions, check_only, jobs=1, output_file=None,
+                   cache_dir="", cache_size=2048, pil_thumbnail=False, resume=False, report_metrics=False):
     vlog("Process each PNG file and perform the required operations.")
-    main_img_size = (4000,8000)
-    thumb_img_size = (400, 800)
-    main_img = np.zeros(main_img_size, dtype=np.uint8)
-    thumb_img = np.zeros(thumb_img_size, dtype=np.uint8)
+    metrics = Metrics(report_metrics)
     triplets = 0
+    counter = 0
+    sources = Counter()
+    layer_table = []
+
+    # The cache only holds blocks that were actually written
+    if check_only:
+        cache_dir = ""
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+
+    header = f"JieHe,{layer_height},4000,8000,2,030,0,FA\n".encode()
+    if output_file is None:
+        output_file = os.path.normpath(png_folder) + ".qdx"
+    # Write the binary run store rather than QDX text
+    runs = output_file.endswith(".qdr") and not check_only
+    # Compressed QDX text, written in blocks that can't be journaled one layer at a time
+    compressed = qdx.compression(output_file) != "" and not runs and not check_only
+    layers = [(os.path.join(png_folder, file_name), counter, len(png_files), png_dimensions, check_only, cache_dir,
+               pil_thumbnail, runs)
+              for counter, file_name in enumerate(sorted(png_files), 1)]
 
     if check_only:
         qdx_file = ""
+    elif runs or compressed:
+        if resume:
+            raise ValueError("--resume is only available for uncompressed QDX output.")
+        qdx_file = (qdx.RunsWriter if runs else qdx.QdxWriter)(output_file, header.decode().strip())
     else:
-        qdx_file = open(png_folder + ".qdx", "w")
-        qdx_file.write(f"JieHe,{layer_height},4000,8000,2,030,0,FA\n")
-    
-    for counter, file_name in enumerate(sorted(png_files), 1):
-        vlog("Processing " + file_name + " (" + str(counter) + "/" + str(len(png_files)) + ")")
-        image_path = os.path.join(png_folder, file_name)
-        image = Image.open(image_path).convert("L")
-        # Scale and center the main image
-        centered_main = center_image(np.where(np.array(image) < 128, 0, 1), main_img.shape)
-        # Scale down by factor of 10 and center the thumbnail image
-        thumb_scaled = image.resize((png_dimensions[0] // 10, png_dimensions[1] // 10))
-        centered_thumb = center_image(np.where(np.array(thumb_scaled) < 128, 0, 1), thumb_img.shape)
-
-        triplets += write_image_data(qdx_file, centered_main, centered_thumb, counter, check_only)
+        # The journal records every complete layer, so that an interrupted run can be resumed
+        journal_path = output_file + ".journal"
+        job = f"# {os.path.abspath(png_folder)}|{len(png_files)}|{layer_height}|{'pil' if pil_thumbnail else 'reduced'}\n"
+        if resume:
+            resumed_file, layer_table = resume_output(output_file, journal_path, job, len(header))
+            if layer_table:
+                counter, triplets = layer_table[-1][0], sum(layer[1] for layer in layer_table)
+                layers = layers[counter:]
+                vlog(f"Resuming after layer {counter}, {triplets} triplets so far")
+            qdx_file = qdx.QdxWriter(output_file, header.decode().strip(), resumed_file, counter, triplets)
+            journal = open(journal_path, "a")
+        else:
+            qdx_file = qdx.QdxWriter(output_file, header.decode().strip())
+            journal = open(journal_path, "w")
+            journal.write(job)
+
+    for counter, block, layer_triplets, layer_size, source, timings in encoded_layers(layers, jobs):
+        metrics.add(counter, **timings)
+        with metrics.stage(counter, "write"):
+            if runs:
+                qdx_file.write(block)
+            elif not check_only:
+                qdx_file.write_block(counter, block, layer_triplets)
+                if not compressed:
+                    record_layer(qdx_file.file, journal, counter, triplets + layer_triplets)
+        # A QDX layer has a line for its counter, FB and FC besides the triplets
+        metrics.add(counter, triplets=layer_triplets, bytes=layer_size)
+        if not runs:
+            metrics.add(counter, lines=layer_triplets + 3)
+        triplets += layer_triplets
+        sources[source] += 1
+        layer_table.append((counter, layer_triplets, layer_size))
         vlog(f"Done. Total triplets: {triplets}")
 
-    if not check_only:
-        qdx_file.write("FD\n")
-        qdx_file.write(f"{counter}|{triplets + counter * 2}\n")
+    recap = f"FD\n{counter}|{triplets + counter * 2}\n".encode()
+    if check_only:
+        print_layer_table(layer_table)
+    else:
+        # A QDR file ends with its block table, a QDX file with the FD recap and gets its layer index
+        qdx_file.close()
+    if not (check_only or runs or compressed):
+        # The file is complete, nothing left to resume
+        journal.close()
+        os.remove(journal_path)
     vlog(f"Recap FD: {counter}|{triplets + counter * 2}")
+    file_size = os.path.getsize(output_file) if runs else len(header) + sum(size for _, _, size in layer_table) + len(recap)
+    vlog(f"{'Projected' if check_only else 'Written'} {'qdr' if runs else 'qdx'} file size: {file_size} bytes")
+    if compressed:
+        compressed_size = os.path.getsize(output_file)
+        vlog(f"Compressed to {compressed_size} bytes, {file_size / max(compressed_size, 1):.1f} times smaller")
+    vlog(f"Layers: {sources['encoded']} encoded, {sources['duplicate']} reused from the previous layer, "
+         f"{sources['cache']} from the layer cache")
+    if cache_dir:
+        prune_cache(cache_dir, cache_size)
+    if resource is not None:
+        vlog(f"Peak RSS: main process {peak_rss_mb():.0f} MB, largest worker {peak_rss_mb(resource.RUSAGE_CHILDREN):.0f} MB")
+    metrics_file = metrics.write(output_file, "qdxfromPNG")
+    if metrics_file:
+        vlog(f"Metrics in {metrics_file}")
 
+def record_layer(qdx_file, journal, counter, triplets):
+    """Make a written layer durable, then record its end offset and the triplets so far."""
+    qdx_file.flush()
+    os.fsync(qdx_file.fileno())
+    journal.write(f"{counter},{qdx_file.tell()},{triplets}\n")
+    journal.flush()
+    os.fsync(journal.fileno())
 
-def center_image(img_array, target_size):
-    vlog(f"Center img_array within a {target_size} array of zeros.")
-    centered_array = np.zeros(target_size, dtype=np.uint8)
-    y_offset = (target_size[0] - img_array.shape[0]) // 2
-    x_offset = (target_size[1] - img_array.shape[1]) // 2
-    centered_array[y_offset:y_offset+img_array.shape[0], x_offset:x_offset+img_array.shape[1]] = img_array
-    return centered_array
+def resume_output(output_file, journal_path, job, header_size):
+    """Reopen an interrupted qdx file after its last journaled layer.
 
-def write_image_data(qdx_file, main_img, thumb_img, counter, check_only):
-    triplets = 0
-    if not check_only: 
-        vlog("Write the processed data of an image to the qdx file.")
-        qdx_file.write(f"{counter}\n")
+    Returns the file, positioned after the last complete FC, and the
+    (counter, triplets, size) of the layers already in it.
+    """
+    try:
+        with open(journal_path) as journal:
+            lines = journal.readlines()
+    except FileNotFoundError:
+        raise ValueError(f"Nothing to resume: {journal_path} was not found.")
+    if not lines or lines[0] != job:
+        raise ValueError(f"{journal_path} was written for another job: {lines[0].strip() if lines else 'empty'}")
+
+    file_size = os.path.getsize(output_file)
+    layer_table = []
+    offset, triplets = header_size, 0
+    for line in lines[1:]:
+        parts = line.strip().split(',')
+        # Stop at a partial line, or at a layer that never fully reached the disk
+        if len(parts) != 3 or not all(part.isdigit() for part in parts):
+            break
+        counter, end, total = map(int, parts)
+        if counter != len(layer_table) + 1 or end > file_size:
+            break
+        layer_table.append((counter, total - triplets, end - offset))
+        offset, triplets = end, total
+
+    # Rewrite the journal without the entries that were dropped
+    with open(journal_path, "w") as journal:
+        journal.writelines(lines[:len(layer_table) + 1])
+    qdx_file = open(output_file, "r+b")
+    qdx_file.truncate(offset)
+    qdx_file.seek(offset)
+    return qdx_file, layer_table
+
+def print_layer_table(layer_table):
+    print("   Layer   Triplets      Bytes")
+    for counter, triplets, size in layer_table:
+        print(f"{counter:8d} {triplets:10d} {size:10d}")
+    busiest = max(layer_table, key=lambda layer: layer[1])
+    print(f"Largest layer: {busiest[0]} with {busiest[1]} triplets, {busiest[2]} bytes")
+
+def export_runs(runs_path, output_file):
+    vlog(f"Export the runs in {runs_path} to {output_file}.")
+    layers, triplets, file_size = qdx.export_qdx(runs_path, output_file)
+    vlog(f"Recap FD: {layers}|{triplets + layers * 2}")
+    vlog(f"Written qdx file size: {file_size} bytes")
+    if qdx.compression(output_file):
+        compressed_size = os.path.getsize(output_file)
+        vlog(f"Compressed to {compressed_size} bytes, {file_size / max(compressed_size, 1):.1f} times smaller")
+
+def encoded_layers(layers, jobs):
+    """Yield (counter, block, triplets, size, source, timings) for each layer, in layer order.
+
+    With more than one job the layers are encoded by a pool of worker
+    processes. At most two layers per worker are in flight, so that only
+    a bounded number of encoded blocks wait in memory for the writer.
+    A layer whose PNG file is identical to the previous one is not sent to
+    be encoded: its block is copied from the previous layer here, in the
+    main process, so that the reuse doesn't depend on which worker had it.
+    """
+    if jobs > 1:
+        vlog(f"Encoding with {jobs} worker processes")
+    window = 2 * jobs if jobs > 1 else 1
+    with ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else nullcontext() as executor:
+        pending = deque()
+        previous_png = None
+        previous = None
+        for layer in layers:
+            start = time.perf_counter()
+            png = png_digest(layer[0])
+            seconds = time.perf_counter() - start
+            duplicate = png == previous_png
+            previous_png = png
+            future = executor.submit(encode_layer, *layer, png) if executor and not duplicate else None
+            pending.append((layer, png, duplicate, future, seconds))
+            while len(pending) >= window:
+                previous = finish_layer(*pending.popleft(), previous)
+                yield previous
+        while pending:
+            previous = finish_layer(*pending.popleft(), previous)
+            yield previous
+
+def finish_layer(layer, png, duplicate, future, seconds, previous):
+    """Return the result of encode_layer for layer, encoding it now unless a worker did or it is a duplicate."""
+    if duplicate:
+        result = reuse_layer(previous, *layer)
+    else:
+        result = future.result() if future else encode_layer(*layer, png)
+    result[5]["png_digest"] = seconds
+    return result
+
+def reuse_layer(previous, image_path, counter, total, png_dimensions, check_only, cache_dir="", pil_thumbnail=False,
+                runs=False):
+    """Return the result of encode_layer for a layer with the same PNG as the previous layer, from its result."""
+    vlog("Processing " + os.path.basename(image_path) + " (" + str(counter) + "/" + str(total) + ")")
+    vlog("Same PNG file as the previous layer, reusing its block")
+    previous_counter, block, triplets, size = previous[:4]
+    # Only the counter line differs, QDR blocks do not hold the layer number
+    previous_line, counter_line = (b"", b"") if runs else (f"{previous_counter}\n".encode(), f"{counter}\n".encode())
+    body = block[len(previous_line):]
+    size += len(counter_line) - len(previous_line)
+    return counter, b"" if check_only else counter_line + body, triplets, size, "duplicate", {}
+
+def encode_layer(image_path, counter, total, png_dimensions, check_only, cache_dir="", pil_thumbnail=False, runs=False,
+                 png=None):
+    """Decode, threshold, center and encode one layer.
+
+    Returns the layer number, the bytes block to write to the qdx file
+    (empty in check only mode), the number of triplets in the block, its
+    size in bytes (also in check only mode), where the block came from:
+    "encoded", "duplicate" when the bitmaps are identical to the previous
+    layer of this process, or "cache", and the seconds spent in each stage.
+    With runs, the block is a QDR block. png is the png_digest() of the
+    file, when the caller already has it.
+    """
+    vlog("Processing " + os.path.basename(image_path) + " (" + str(counter) + "/" + str(total) + ")")
+    # Always timed, the few clock reads are nothing next to a layer
+    timings = Metrics(enabled=True)
+    # QDR blocks do not hold the layer number
+    counter_line = b"" if runs else f"{counter}\n".encode()
+    if cache_dir:
+        if png is None:
+            png = png_digest(image_path)
+        cache_path = os.path.join(cache_dir, cache_key(png, png_dimensions, pil_thumbnail, runs) + ".blk")
+        with timings.stage(counter, "read_cache"):
+            body = read_cached_block(cache_path)
+        if body is not None:
+            vlog("Reusing the cached block")
+            # The body holds the thumbnail and main sections, ended by FB and FC
+            triplets = qdx.runs_block_triplets(body) if runs else body.count(b"\n") - 2
+            return counter, counter_line + body, triplets, len(counter_line) + len(body), "cache", timings.layers[counter]
+
+    main_img_size = (4000, 8000)
+    thumb_img_size = (400, 800)
+    with timings.stage(counter, "decode"):
+        image = Image.open(image_path)
+        if image.mode != "L":
+            image = image.convert("L")
+        # Decode here rather than on the first band of the thresholding, so that both are timed apart
+        image.load()
+    # Scale and center the main image
+    with timings.stage(counter, "threshold"):
+        centered_main = center_image(image, main_img_size, "main_img")
+    # Scale down by factor of 10 and center the thumbnail image
+    start = time.perf_counter()
+    with timings.stage(counter, "thumbnail"):
+        if pil_thumbnail:
+            thumb_scaled = image.resize((png_dimensions[0] // 10, png_dimensions[1] // 10))
+            centered_thumb = center_image(thumb_scaled, thumb_img_size, "thumb_img")
+        else:
+            centered_thumb = reduce_image(centered_main, thumb_img_size, "thumb_img")
+    del image
+    vlog(f"Thumbnail in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    # Prismatic parts have long stretches of identical layers: encode them once.
+    # The frames are overwritten by the next layer, so both are kept packed; the small
+    # thumbnails are compared first, the main bitmaps only once they match
+    with timings.stage(counter, "compare"):
+        thumb_bits = np.packbits(centered_thumb.T)
+        main_bits = np.packbits(centered_main.T)
+        duplicate = (np.array_equal(thumb_bits, previous_layer.get("thumb_bits"))
+                     and np.array_equal(main_bits, previous_layer["main_bits"]))
+    if duplicate:
+        vlog("Identical to the previous layer, reusing its block")
+        body, triplets, size, source = (previous_layer["body"], previous_layer["triplets"],
+                                        len(counter_line) + previous_layer["body_size"], "duplicate")
+    else:
+        with timings.stage(counter, "encode"):
+            block = io.BytesIO()
+            triplets, size = write_image_data(block, centered_main, centered_thumb, counter, check_only, runs)
+            body, source = block.getvalue()[len(counter_line):], "encoded"
+        previous_layer.update(thumb_bits=thumb_bits, main_bits=main_bits, body=body, triplets=triplets,
+                              body_size=size - len(counter_line))
+    if cache_dir:
+        with timings.stage(counter, "write_cache"):
+            write_cached_block(cache_path, body)
+    if resource is not None:
+        vlog(f"Peak RSS: {peak_rss_mb():.0f} MB")
+    return counter, b"" if check_only else counter_line + body, triplets, size, source, timings.layers[counter]
+
+def png_digest(image_path):
+    """Return a digest of the content of the PNG file, which fully determines its pixels."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(image_path, "rb") as png:
+        for chunk in iter(lambda: png.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.digest()
+
+def cache_key(png, png_dimensions, pil_thumbnail, runs):
+    """Return the cache key of a layer: a hash of the png_digest() of its PNG and the target geometry.
+
+    The PNG file content fully determines its pixels, so an unchanged layer
+    is found in the cache without being decoded.
+    """
+    thumbnail = "pil" if pil_thumbnail else "reduced"
+    block_format = "qdr" if runs else "qdx"
+    key = hashlib.sha256(f"v{CACHE_VERSION}|{png_dimensions}|4000x8000|400x800|{thumbnail}|{block_format}|".encode())
+    key.update(png)
+    return key.hexdigest()
+
+def read_cached_block(cache_path):
+    """Return the cached layer body, or None if it is not in the cache."""
+    try:
+        with open(cache_path, "rb") as cached:
+            body = cached.read()
+    except FileNotFoundError:
+        return None
+    # Mark the entry as recently used
+    os.utime(cache_path)
+    return body
+
+def write_cached_block(cache_path, body):
+    # Write to a temporary name first, so that a concurrent reader never sees a partial block
+    temp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as cached:
+        cached.write(body)
+    os.replace(temp_path, cache_path)
+
+def prune_cache(cache_dir, cache_size):
+    """Evict the least recently used blocks until the cache fits in cache_size MB."""
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith(".blk"):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    entries.sort(reverse=True)
+    total = 0
+    evicted = 0
+    for _, size, path in entries:
+        total += size
+        if total > cache_size * 1024 * 1024:
+            os.remove(path)
+            evicted += 1
+    if evicted:
+        vlog(f"Layer cache: evicted {evicted} blocks to stay within {cache_size} MB")
+
+def frame_buffer(name, shape):
+    """Return the persistent boolean buffer name of the given shape."""
+    key = (name, shape)
+    if key not in frame_buffers:
+        frame_buffers[key] = np.zeros(shape, dtype=bool)
+    return frame_buffers[key]
+
+def center_image(image, target_size, name):
+    """Threshold image into the center of the persistent frame name.
+
+    Pixels below 128 become 0 and the others 1. The frame is returned as a
+    uint8 view of target_size; it is only valid until the next call.
+    """
+    vlog(f"Center image within a {target_size} frame of zeros.")
+    # Frames are stored column by column, the order in which they are encoded
+    frame = frame_buffer(name, target_size[::-1]).T
+    width, height = image.size
+    y_offset = (target_size[0] - height) // 2
+    x_offset = (target_size[1] - width) // 2
+    region = (y_offset, x_offset, height, width)
+    # The border stays black as long as the image keeps the same placement
+    if frame_regions.get(name) != region:
+        frame[:] = False
+        frame_regions[name] = region
+    # Convert the image in bands of rows, so no full size copy is ever made
+    for top in range(0, height, THRESHOLD_BAND):
+        bottom = min(top + THRESHOLD_BAND, height)
+        band = np.asarray(image.crop((0, top, width, bottom)))
+        np.greater_equal(band, 128, out=frame[y_offset+top:y_offset+bottom, x_offset:x_offset+width])
+    return frame.view(np.uint8)
+
+def reduce_image(img, target_size, name):
+    """Scale the thresholded img down into the persistent frame name.
+
+    Each thumbnail pixel is on when at least half of the pixels of its
+    block in img are on, which is close to thresholding a PIL resize of
+    the grayscale image. Returns a uint8 view like center_image().
+    """
+    vlog(f"Reduce image into a {target_size} frame.")
+    frame = frame_buffer(name, target_size[::-1])
+    factor_y, factor_x = img.shape[0] // target_size[0], img.shape[1] // target_size[1]
+    # Work on the column-major layout of img, adding up whole columns first so
+    # that the full size bitmap is read only once, then the strided rows
+    columns = img.T.reshape(target_size[1], factor_x, img.shape[0])
+    lit_columns = np.zeros((target_size[1], img.shape[0]), dtype=np.uint8)
+    for offset in range(factor_x):
+        lit_columns += columns[:, offset]
+    lit = np.zeros(frame.shape, dtype=np.uint16)
+    for offset in range(factor_y):
+        lit += lit_columns[:, offset::factor_y]
+    np.greater_equal(lit, (factor_x * factor_y + 1) // 2, out=frame)
+    frame_regions.pop(name, None)
+    return frame.T.view(np.uint8)
+
+def write_image_data(qdx_file, main_img, thumb_img, counter, check_only, runs=False):
+    """Write a layer block and return its number of triplets and its size in bytes."""
     vlog("Thumb image processing")
-    triplets += write_triplets(thumb_img, qdx_file, check_only)
-    if not check_only: 
-        qdx_file.write("FB\n")
+    thumbnail = image_runs(thumb_img, check_only)
     vlog("Main image processing")
-    triplets += write_triplets(main_img, qdx_file, check_only)
-    if not check_only: 
-        qdx_file.write("FC\n")
-    return triplets
+    main = image_runs(main_img, check_only)
+    triplets = len(thumbnail[0]) + len(main[0])
+    if check_only:
+        # The counter line, FB and FC besides the triplets
+        return triplets, len(f"{counter}\n") + triplets_size(*thumbnail) + len(b"FB\n") + triplets_size(*main) + len(b"FC\n")
+    if runs:
+        vlog("Write the runs of an image as a QDR block.")
+        block = qdx.runs_block(qdx.pack_runs(*thumbnail), qdx.pack_runs(*main))
+    else:
+        vlog("Write the processed data of an image to the qdx file.")
+        block = qdx.Layer(counter, thumbnail, main).block()
+    qdx_file.write(block)
+    return triplets, len(block)
 
-def write_triplets(img, qdx_file, check_only):
+def image_runs(img, check_only):
     if check_only:
         vlog("Count triplets for each column change in img.")
     else:
-        vlog("Write triplets for each column change in img to the qdx file.")
-    triplets = 0
-    for column in range(img.shape[1]):
-        prev_val = img[0, column]
-        count = 1
-        for row in range(1, img.shape[0]):
-            if img[row, column] == prev_val:
-                count += 1
-            else:
-                if count != img.shape[0]:
-                    if not check_only: 
-                        qdx_file.write(f"{column},{count},{prev_val}\n")
-                    triplets += 1
-                prev_val = img[row, column]
-                count = 1
-        # Process the last segment
-        if count != img.shape[0]:
-            if not check_only: 
-                qdx_file.write(f"{column},{count},{prev_val}\n")
-            triplets += 1
-    vlog(f"Done. Triplets: {triplets}")
-    return triplets
+        vlog("Find triplets for each column change in img.")
+    start = time.perf_counter()
+    runs = column_runs(img)
+    vlog(f"Done. Triplets: {len(runs[0])} in {(time.perf_counter() - start) * 1000:.1f} ms")
+    return runs
+
+def column_runs(img):
+    """Run-length encode img column by column.
+
+    Returns three arrays (column, count, value), one entry per run, in the
+    same order the per-pixel scan would find them. Runs that span a whole
+    column are dropped, as the QDX format only lists columns with changes.
+
+    Columns are scanned in blocks: empty columns of a block are skipped
+    outright, and transitions are only searched within the rows occupied
+    by the remaining ones.
+    """
+    rows = img.shape[0]
+    # Lay the columns out one after the other, so that runs are contiguous
+    columns = np.ascontiguousarray(img.T)
+    runs_columns, runs_counts, runs_values = [], [], []
+    occupied = 0
+    top, bottom = rows, 0
+    for first in range(0, columns.shape[0], RUNS_BLOCK):
+        block = columns[first:first+RUNS_BLOCK]
+        # Occupancy mask: empty columns have no runs to write. Compare 8 pixels at a time when possible.
+        words = block.view(np.uint64) if rows % 8 == 0 else block
+        active = np.flatnonzero(words.max(axis=1))
+        if len(active) == 0:
+            continue
+        if len(active) < len(block):
+            block, words = block[active], words[active]
+        # Outside the occupied rows every column of the block is 0, so no run starts there
+        filled = np.flatnonzero(np.bitwise_or.reduce(words, axis=0).view(block.dtype))
+        low, high = max(filled[0] - 1, 0), min(filled[-1] + 2, rows)
+        top, bottom = min(top, filled[0]), max(bottom, filled[-1] + 1)
+        # A run starts at the top of every column and wherever the value changes.
+        # The first mask column stands for row 0: row low itself never changes.
+        starts_mask = np.empty((len(active), high - low), dtype=bool)
+        starts_mask[:, 0] = True
+        np.not_equal(block[:, low+1:high], block[:, low:high-1], out=starts_mask[:, 1:])
+        starts = np.flatnonzero(starts_mask)
+        if high - low == rows:
+            starts_column = starts // rows
+        else:
+            starts_column, starts_row = np.divmod(starts, high - low)
+            starts_row[starts_row != 0] += low
+            starts = starts_column * rows + starts_row
+        counts = np.diff(starts, append=block.size)
+        # Columns that are all 1 are a single run spanning the whole column
+        keep = counts != rows
+        starts_column = starts_column[keep]
+        runs_columns.append(active[starts_column] + first)
+        runs_counts.append(counts[keep])
+        runs_values.append(block.ravel()[starts[keep]])
+        if len(starts_column):
+            occupied += np.count_nonzero(np.diff(starts_column)) + 1
+    if occupied:
+        vlog(f"Occupied: {occupied} of {columns.shape[0]} columns, rows {top} to {bottom - 1}")
+    else:
+        vlog("Occupied: no columns")
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint8)
+    return np.concatenate(runs_columns), np.concatenate(runs_counts), np.concatenate(runs_values)
 
 if __name__ == "__main__":
     start_time = current_time()
     try:
-        layer_height, png_folder, check_only = read_parameters(sys.argv)
+        (layer_height, png_folder, check_only, jobs, output_file, cache_dir, cache_size,
+         pil_thumbnail, resume, export_file, report_metrics) = read_parameters(sys.argv)
+        if export_file:
+            export_runs(export_file, output_file)
+            sys.exit(0)
         png_files, png_dimensions = validate_png_files(png_folder)
-        process_images(png_folder, png_files, layer_height, png_dimensions, check_only)
+        process_images(png_folder, png_files, layer_height, png_dimensions, check_only, jobs, output_file,
+                       cache_dir, cache_size, pil_thumbnail, resume, report_metrics)
         vlog(f"Successfully processed all images since {start_time}")
     except Exception as e:
         print(f"Error: {e}")
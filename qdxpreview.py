@@ -0,0 +1,331 @@
+import sys
+import os
+import re
+import io
+import time
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+import cv2
+import numpy as np
+from PIL import Image
+import qdx
+from qdxanalyzer import render_layer, X, Y
+
+#################################################
+#
+# Local preview server of the layers of a qdx file, or of a qdr run store,
+# drawn like the frames of qdxanalyzer.py:
+#
+#   /                   a page to flip through the layers with the arrow keys
+#   /layer/N.png        layer N at full size, 8000 x 4000
+#   /layer/N.png?thumb  the 800 x 400 thumbnail of layer N
+#
+# The runs of the layers and the PNGs are kept in LRU caches, and the layers
+# next to the last one viewed are rendered ahead in the background, so that
+# flipping through the layers doesn't wait for the rendering.
+#
+#################################################
+
+# Record the start time
+start_time = time.time()
+
+def help():
+    print("QDX Preview")
+    print("Usage: python qdxpreview.py <filename> <optional port> <optional --cache MB>")
+    print("     <filename>: the qdx file, also compressed as .qdx.gz or .qdx.xz, or a qdr run store written by qdxfromPNG.py")
+    print("     <optional port>: default is 8000, the server only answers on this computer (127.0.0.1)")
+    print("     <optional --cache MB>: memory for the cached layers and PNGs, default is 512")
+    sys.exit(1)
+
+# Prints timestamp and msg
+def vlog(msg):
+  print(f"{datetime.fromtimestamp(time.time()-start_time).strftime('%H:%M:%S')} - {msg}")
+
+def read_parameters(argv):
+    if len(argv) < 2:
+        help()
+
+    filename = ""
+    port = 8000
+    cache_mb = 512
+
+    # Read command line parameters:
+    args = iter(argv[1:])
+    for arg in args:
+        # Memory of the caches
+        if arg == "--cache":
+            value = next(args, "")
+            if not value.isdigit() or int(value) < 1:
+                print(f"Error: {arg} requires a size in MB.")
+                help()
+            cache_mb = int(value)
+
+        # Filename
+        elif arg.endswith(qdx.QDX_EXTENSIONS + (".qdr",)):
+            if os.path.isfile(arg):
+                filename = arg
+            else:
+                print(f"Error: The file '{arg}' was not found.")
+                help()
+
+        # Port
+        elif arg.isdigit():
+            port = int(arg)
+
+        else:
+            print(f"Error: unknown parameter {arg}.")
+            help()
+
+    if filename == "":
+        help()
+
+    print(f"Running {sys.argv[0]} with the following parameters:")
+    print(f"   Input file:   {filename}")
+    print(f"   Port:         {port}")
+    print(f"   Cache:        {cache_mb} MB")
+
+    return filename, port, cache_mb
+
+class LruCache:
+    """Values of a known size in bytes, the least recently used ones evicted beyond max_bytes.
+
+    Shared by the request threads and the prefetching thread.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+    def put(self, key, value, size):
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.size += size
+            # The last value stays even if it is larger than the cache
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= evicted
+
+class LayerPreviews:
+    """The PNG of every layer of a qdx or qdr file, full size or thumbnail size, rendered once.
+
+    A PNG is rendered by the first thread that asks for it, the request
+    thread or the prefetching thread, and the other ones wait for it.
+    """
+    neighbours = 2          # layers rendered ahead on each side of the last one viewed
+    queued_prefetches = 4
+
+    def __init__(self, filename, cache_mb):
+        self.reader = qdx.LayerReader(filename)
+        self.header = self.reader.header
+        self.layers = sorted(self.reader.numbers)
+        self.runs = LruCache(cache_mb * 1024 * 1024 // 4)
+        self.pngs = LruCache(cache_mb * 1024 * 1024 - self.runs.max_bytes)
+        self.rendering = {}
+        self.lock = threading.Lock()
+        self.frames = {}
+        self.prefetcher = ThreadPoolExecutor(max_workers=1)
+        self.prefetching = 0
+
+    # The rows, segment lengths and laser states of a layer, or None if it is not in the file
+    # Both sections of a layer are cached, the thumbnail and the full size views go together
+    def layer_runs(self, layer, thumb):
+        key = (layer, thumb)
+        runs = self.runs.get(key)
+        if runs is None:
+            read = self.reader.layer(layer)
+            if read is None:
+                return None
+            for section_thumb, section in ((True, read.thumbnail), (False, read.main)):
+                self.runs.put((layer, section_thumb), section, sum(values.nbytes for values in section))
+            runs = read.thumbnail if thumb else read.main
+        return runs
+
+    def png(self, layer, thumb):
+        """Return the PNG of a layer, or None if it is not in the file, and the time it was rendered in, if it was."""
+        key = (layer, thumb)
+        png = self.pngs.get(key)
+        if png is not None:
+            return png, None
+        future, owner = self.claim(key)
+        if owner:
+            self.render(key, future)
+        return future.result()
+
+    # Render the layers around layer in the background, the nearest first
+    def prefetch(self, layer, thumb):
+        for distance in range(1, self.neighbours + 1):
+            for neighbour in (layer + distance, layer - distance):
+                key = (neighbour, thumb)
+                if neighbour not in self.layers or key in self.pngs or self.prefetching >= self.queued_prefetches:
+                    continue
+                future, owner = self.claim(key)
+                if owner:
+                    with self.lock:
+                        self.prefetching += 1
+                    self.prefetcher.submit(self.render, key, future, True)
+
+    # The future of the PNG of key, and whether the caller has to render it
+    def claim(self, key):
+        with self.lock:
+            if key in self.rendering:
+                return self.rendering[key], False
+            future = self.rendering[key] = Future()
+            return future, True
+
+    def render(self, key, future, prefetched=False):
+        layer, thumb = key
+        try:
+            since = time.perf_counter()
+            runs = self.layer_runs(layer, thumb)
+            if runs is None:
+                future.set_result((None, None))
+                return
+            frame_buffer = self.frame(thumb)
+            try:
+                render_layer(layer, *runs, frame_buffer)
+                png = encode_png(frame_buffer)
+            finally:
+                self.frames[thumb].put(frame_buffer)
+            self.pngs.put(key, png, len(png))
+            future.set_result((png, time.perf_counter() - since))
+        except Exception as error:
+            future.set_exception(error)
+        finally:
+            with self.lock:
+                del self.rendering[key]
+                if prefetched:
+                    self.prefetching -= 1
+
+    # A frame buffer of the size of the layer or of its thumbnail, reused from one rendering to the next
+    def frame(self, thumb):
+        with self.lock:
+            free = self.frames.setdefault(thumb, queue.Queue())
+        try:
+            return free.get_nowait()
+        except queue.Empty:
+            return np.zeros((X // 10, Y // 10, 3) if thumb else (X, Y, 3), dtype=np.uint8)
+
+    def page(self):
+        first, last = (self.layers[0], self.layers[-1]) if len(self.layers) else (0, 0)
+        return PAGE.replace("FIRST", str(first)).replace("LAST", str(last)).encode()
+
+# The frames are black, white, red and the grays on the edges of the layer number,
+# so they fit a palette PNG of one byte per pixel, encoded several times faster than
+# three channels. Red takes the place of the darkest gray, which turns black
+PALETTE = [level for gray in range(256) for level in (gray, gray, gray)]
+PALETTE[3:6] = [255, 0, 0]
+
+def encode_png(frame_buffer):
+    height, width = frame_buffer.shape[:2]
+    indexes = cv2.extractChannel(frame_buffer, 0)
+    red = cv2.compare(cv2.extractChannel(frame_buffer, 2), indexes, cv2.CMP_GT)
+    indexes[indexes == 1] = 0
+    indexes[red > 0] = 1
+    image = Image.frombuffer("P", (width, height), indexes, "raw", "P", 0, 1)
+    image.putpalette(PALETTE)
+    png = io.BytesIO()
+    image.save(png, "PNG", compress_level=1)
+    return png.getvalue()
+
+PAGE = """<!DOCTYPE html>
+<html><head><title>QDX preview</title>
+<style>body { background: #222; color: #ddd; font-family: sans-serif; } img { max-width: 100%; }</style>
+</head><body>
+<p>Layer <input id="layer" type="number" min="FIRST" max="LAST" value="FIRST"> of FIRST to LAST,
+<label><input id="thumb" type="checkbox"> thumbnail</label>,
+left and right arrows to flip through the layers</p>
+<img id="frame">
+<script>
+const layer = document.getElementById("layer"), thumb = document.getElementById("thumb");
+const frame = document.getElementById("frame");
+function show() { frame.src = "/layer/" + layer.value + ".png" + (thumb.checked ? "?thumb" : ""); }
+function flip(step) { layer.value = Math.min(LAST, Math.max(FIRST, Number(layer.value) + step)); show(); }
+document.addEventListener("keydown", event => {
+  if (event.key == "ArrowRight") flip(1);
+  if (event.key == "ArrowLeft") flip(-1);
+});
+layer.addEventListener("change", show);
+thumb.addEventListener("change", show);
+show();
+</script>
+</body></html>
+"""
+
+class PreviewHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        since = time.perf_counter()
+        previews = self.server.previews
+        url = urlsplit(self.path)
+        layer = re.fullmatch(r"/layer/(\d+)\.png", url.path)
+        if url.path == "/":
+            self.reply(200, "text/html; charset=utf-8", previews.page())
+        elif layer is None:
+            self.reply(404, "text/plain", b"Not found\n")
+        else:
+            layer, thumb = int(layer.group(1)), "thumb" in parse_qs(url.query, keep_blank_values=True)
+            png, rendering = previews.png(layer, thumb)
+            if png is None:
+                self.reply(404, "text/plain", f"Layer {layer} not found in file\n".encode())
+                return
+            self.reply(200, "image/png", png)
+            previews.prefetch(layer, thumb)
+            vlog(f"Layer {layer}{' thumbnail' if thumb else ''}: {len(png)} bytes in "
+                 f"{(time.perf_counter() - since) * 1000:.1f} ms, "
+                 f"{f'rendered in {rendering * 1000:.1f} ms' if rendering is not None else 'cached'}")
+
+    def reply(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Only the errors, every layer served is reported by do_GET
+    def log_request(self, code="-", size="-"):
+        pass
+
+    def log_message(self, format, *args):
+        vlog(format % args)
+
+def main(filename, port, cache_mb):
+    vlog(f"Opening {filename}...")
+    previews = LayerPreviews(filename, cache_mb)
+    vlog(f"{len(previews.layers)} layers, header {previews.header}")
+    server = ThreadingHTTPServer(("127.0.0.1", port), PreviewHandler)
+    server.daemon_threads = True
+    server.previews = previews
+    vlog(f"Serving the layers on http://127.0.0.1:{port}/, Ctrl+C to stop")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    vlog(f"PNG cache: {previews.pngs.hits} hits, {previews.pngs.misses} misses")
+
+if __name__ == "__main__":
+    vlog("Start preview server")
+    main(*read_parameters(sys.argv))
+    vlog("Finished")
@@ -0,0 +1,161 @@
+import sys
+import os
+import csv
+import json
+import time
+from datetime import datetime
+import numpy as np
+import qdx
+
+#################################################
+#
+# Statistics of every layer of a qdx file, or of a qdr run store, in one pass.
+#
+# Written to <filename>_stats.csv, one row per layer, and <filename>_stats.json,
+# one list per column, with the totals of the file:
+#
+#   layer                layer number
+#   thumbnail_triplets   triplets before "FB"
+#   thumbnail_laser_on   of which with the laser on, the lines ending with ",1"
+#   triplets             triplets between "FB" and "FC"
+#   laser_on             of which with the laser on
+#   active_rows          rows with at least one laser on segment
+#   exposed_area         pixels under the laser, with the segments clipped to X
+#   min_row, max_row     bounding box of the exposed pixels, in the coordinates of the file:
+#   min_x, max_x         the even layers are not mirrored. Empty for a layer with no exposed pixel
+#
+# The totals also give the numbers of the former count_segments.py (laser on
+# row changes) and FD.py (lines ending with ",1") scripts.
+#
+#################################################
+
+# Record the start time
+start_time = time.time()
+
+X = 4000
+
+COLUMNS = ["layer", "thumbnail_triplets", "thumbnail_laser_on", "triplets", "laser_on", "active_rows",
+           "exposed_area", "min_row", "max_row", "min_x", "max_x"]
+
+def help():
+    print("QDX Stats")
+    print("Usage: python qdxstats.py <filename> <optional -o output>")
+    print("     <filename>: the qdx file, also compressed as .qdx.gz or .qdx.xz, or a qdr run store written by qdxfromPNG.py")
+    print("     <optional -o output>: the statistics go to <output>.csv and <output>.json,")
+    print("                           default is <filename>_stats")
+    sys.exit(1)
+
+# Prints timestamp and msg
+def vlog(msg):
+  print(f"{datetime.fromtimestamp(time.time()-start_time).strftime('%H:%M:%S')} - {msg}")
+
+def read_parameters(argv):
+    if len(argv) < 2:
+        help()
+
+    filename = ""
+    output = ""
+
+    # Read command line parameters:
+    args = iter(argv[1:])
+    for arg in args:
+        # Output files
+        if arg in ("-o", "--output"):
+            output = next(args, "")
+            if output == "":
+                print(f"Error: {arg} requires a file name.")
+                help()
+
+        # Filename
+        elif arg.endswith(qdx.QDX_EXTENSIONS + (".qdr",)):
+            if os.path.isfile(arg):
+                filename = arg
+            else:
+                print(f"Error: The file '{arg}' was not found.")
+                help()
+
+        else:
+            print(f"Error: unknown parameter {arg}.")
+            help()
+
+    if filename == "":
+        help()
+    if output == "":
+        output = qdx.base_path(filename) + "_stats"
+    output = os.path.splitext(output)[0] if output.endswith((".csv", ".json")) else output
+
+    print(f"Running {sys.argv[0]} with the following parameters:")
+    print(f"   Input file:   {filename}")
+    print(f"   Output files: {output}.csv, {output}.json")
+
+    return filename, output
+
+# The statistics of the print triplets of a layer
+def section_stats(rows, segment_lengths, laser_ons):
+    on = laser_ons == 1
+    stats = {"triplets": len(rows), "laser_on": int(np.count_nonzero(on)), "active_rows": 0, "exposed_area": 0,
+             "min_row": None, "max_row": None, "min_x": None, "max_x": None}
+    if not on.any():
+        return stats
+    # The rows are consecutive, so every change of row among the laser on segments is a new active row
+    stats["active_rows"] = int(np.count_nonzero(np.diff(rows[on]))) + 1
+    _, segment_ends = qdx.segment_bounds(rows, segment_lengths)
+    starts = np.minimum((segment_ends - segment_lengths)[on], X)
+    ends = np.minimum(segment_ends[on], X)
+    exposed = ends > starts
+    stats["exposed_area"] = int((ends - starts).sum())
+    if exposed.any():
+        exposed_rows = rows[on][exposed]
+        stats.update(min_row=int(exposed_rows.min()), max_row=int(exposed_rows.max()),
+                     min_x=int(starts[exposed].min()), max_x=int(ends[exposed].max()) - 1)
+    return stats
+
+def main(filename, output):
+    columns = {name: [] for name in COLUMNS}
+    # count_segments.py counted the changes of row among the laser on lines across the whole file
+    row_changes = 0
+    previous_row = None
+
+    vlog(f"Opening and reading {filename}...")
+    with qdx.LayerReader(filename) as reader:
+        vlog(f"Header: {reader.header}")
+        for layer in reader:
+            stats = section_stats(*layer.main)
+            stats.update(layer=layer.number, thumbnail_triplets=len(layer.thumbnail[0]),
+                         thumbnail_laser_on=int(np.count_nonzero(layer.thumbnail[2] == 1)))
+            for name in COLUMNS:
+                columns[name].append(stats[name])
+            for rows, _, laser_ons in (layer.thumbnail, layer.main):
+                on_rows = rows[laser_ons == 1]
+                if len(on_rows):
+                    row_changes += int(np.count_nonzero(np.diff(on_rows))) + (on_rows[0] != previous_row)
+                    previous_row = on_rows[-1]
+            if layer.number % 100 == 0:
+                vlog(f"Processing layer {layer.number}")
+
+    totals = {
+        "layers": len(columns["layer"]),
+        "thumbnail_triplets": sum(columns["thumbnail_triplets"]),
+        "triplets": sum(columns["triplets"]),
+        "laser_on_lines": sum(columns["thumbnail_laser_on"]) + sum(columns["laser_on"]),
+        "laser_on_row_changes": int(row_changes),
+        "exposed_area": sum(columns["exposed_area"]),
+    }
+    vlog(f"Layers: {totals['layers']}")
+    vlog(f"Triplets: {totals['thumbnail_triplets']} in the thumbnails, {totals['triplets']} in the print")
+    vlog(f"Lines ending with ',1': {totals['laser_on_lines']}")
+    vlog(f"Laser on row changes: {totals['laser_on_row_changes']}")
+    vlog(f"Exposed area: {totals['exposed_area']} pixels")
+
+    with open(output + ".csv", "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(COLUMNS)
+        writer.writerows(zip(*columns.values()))
+    with open(output + ".json", "w") as file:
+        json.dump({"file": filename, "totals": totals, "columns": columns}, file)
+    vlog(f"Statistics in {output}.csv and {output}.json")
+
+if __name__ == "__main__":
+    vlog("Start statistics")
+    main(*read_parameters(sys.argv))
+    vlog("Finished")
@@ -0,0 +1,37 @@
+import numpy as np
+import qdx
+
+HEADER = "JieHe,50,4000,8000,2,030,0,FA"
+
+
+def write_layers(path):
+    """Write three layers, the second one without thumbnail, and return them."""
+    layers = [qdx.Layer(1, qdx.read_triplets(b"0,400,0\n"), qdx.read_triplets(b"0,4000,0\n1,1000,1\n1,3000,0\n")),
+              qdx.Layer(2, qdx.read_triplets(b""), qdx.read_triplets(b"0,4000,1\n")),
+              qdx.Layer(3, qdx.read_triplets(b"0,200,1\n0,200,0\n"), qdx.read_triplets(b"0,4000,0\n"))]
+    with qdx.QdxWriter(str(path), HEADER) as writer:
+        for layer in layers:
+            writer.write(layer)
+    return layers
+
+
+def assert_same_layers(read, written):
+    assert [layer.number for layer in read] == [layer.number for layer in written]
+    for got, expected in zip(read, written):
+        for got_column, expected_column in zip(got.thumbnail + got.main, expected.thumbnail + expected.main):
+            assert np.array_equal(got_column, expected_column)
+
+
+def test_crlf_file_is_read_like_lf(tmp_path):
+    written = write_layers(tmp_path / "lf.qdx")
+    crlf = tmp_path / "crlf.qdx"
+    crlf.write_bytes((tmp_path / "lf.qdx").read_bytes().replace(b"\n", b"\r\n"))
+    index = qdx.build_index(str(crlf))
+    assert index["layer"].tolist() == [1, 2, 3]
+    assert index["triplets"].tolist() == [4, 1, 3]
+    with qdx.LayerReader(str(crlf)) as reader:
+        assert reader.header == HEADER
+        assert_same_layers(list(reader), written)
+        assert_same_layers([reader.layer(2)], written[1:2])
+    with qdx.QdxFile(str(crlf)) as qdx_file:
+        assert qdx_file.recap() == (3, 8 + 2 * 3)
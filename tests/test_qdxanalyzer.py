@@ -0,0 +1,49 @@
+import qdxanalyzer
+
+
+def layer_lines(number, main=("0,4000,0", "1,4000,1")):
+    """The lines of a layer with a one row thumbnail and the main rows main."""
+    return [str(number), "0,400,0", "FB", *main, "FC"]
+
+
+def test_layer_missing_fc_is_checked(capsys):
+    lines = layer_lines(1)[:-1] + layer_lines(2, ("0,4000,0", "1,4100,1")) + layer_lines(3)
+    layer_count, current_layer, triplets, error_layers, _, _ = qdxanalyzer.analyze_lines(
+        lines, 1, 3, 0, 0, None)
+    assert (layer_count, current_layer, triplets) == (3, 3, 9)
+    assert error_layers == [1, 2]
+    output = capsys.readouterr().out
+    assert "Error in layer 1: missing FC" in output
+    assert "Error in layer 2: row 1 exceeds limits" in output
+
+
+def test_truncated_layer_is_checked(capsys):
+    lines = layer_lines(1) + layer_lines(2, ("0,3000,0", "1,4000,1"))[:-1]
+    _, _, _, error_layers, _, _ = qdxanalyzer.analyze_lines(lines, 1, 2, 0, 0, None)
+    assert error_layers == [2]
+    output = capsys.readouterr().out
+    assert "Error in layer 2: missing FC" in output
+    assert "Error in layer 2: row 1 is too short" in output
+
+
+def analyzer_report(capsys, argv):
+    parameters = qdxanalyzer.read_parameters(["qdxanalyzer.py", *argv])
+    capsys.readouterr()
+    qdxanalyzer.main(*parameters)
+    # Without the time stamps and the lines about the worker processes
+    lines = capsys.readouterr().out.replace("\r", "\n").splitlines()
+    return [line.split(" - ", 1)[-1] for line in lines if not line.startswith("[") and "worker processes" not in line]
+
+
+def test_parallel_report_with_a_malformed_chunk(tmp_path, capsys):
+    lines = ["JieHe,50,4000,8000,2,030,0,FA"]
+    for number in range(1, 41):
+        lines += layer_lines(number)
+    # A stray layer number in the print section of layer 10, which the line parser takes for layer 7
+    lines.insert(lines.index("10") + 3, "7")
+    path = tmp_path / "stray.qdx"
+    path.write_text("\n".join(lines + ["FD", "40|200"]) + "\n")
+    serial = analyzer_report(capsys, [str(path)])
+    assert "Error in layer 11: layer number doesn't match the sequence 12" in serial
+    assert "Recap compliance failed: found 41 layers, expected 40." in serial
+    assert analyzer_report(capsys, [str(path), "-j", "2"]) == serial
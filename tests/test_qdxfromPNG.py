@@ -0,0 +1,36 @@
+import numpy as np
+from PIL import Image
+import qdxfromPNG
+
+
+def layer_pngs(folder, compress_levels):
+    """Write one PNG per compression level, all with the same pixels."""
+    pixels = np.zeros((800, 400), dtype=np.uint8)
+    pixels[100:300, 50:200] = 255
+    paths = []
+    for number, level in enumerate(compress_levels, 1):
+        path = folder / f"layer{number:04d}.png"
+        Image.fromarray(pixels).save(path, compress_level=level)
+        paths.append(str(path))
+    return paths
+
+
+def layers(paths):
+    return [(path, counter, len(paths), (400, 800), False, "", False, False) for counter, path in enumerate(paths, 1)]
+
+
+def test_identical_bitmaps_reuse_the_previous_block(tmp_path, monkeypatch):
+    # Different PNG files, so only the comparison of the bitmaps finds the repeat
+    monkeypatch.setattr(qdxfromPNG, "previous_layer", {})
+    paths = layer_pngs(tmp_path, (1, 9))
+    first, second = (qdxfromPNG.encode_layer(*layer) for layer in layers(paths))
+    assert (first[4], second[4]) == ("encoded", "duplicate")
+    assert second[1] == b"2\n" + first[1][len(b"1\n"):]
+    assert second[2:4] == (first[2], first[3])
+
+
+def test_identical_pngs_are_reused_with_jobs(tmp_path):
+    paths = layer_pngs(tmp_path, (6, 6, 6))
+    results = list(qdxfromPNG.encoded_layers(layers(paths), jobs=2))
+    assert [result[4] for result in results] == ["encoded", "duplicate", "duplicate"]
+    assert [result[1].split(b"\n", 1)[0] for result in results] == [b"1", b"2", b"3"]